@@ -1,21 +1,35 @@
 import os
 import re
 import io
+import asyncio
 import base64
+import hashlib
 import json
+import math
+import mmap
 import random
-from dataclasses import dataclass
-from typing import Dict, Any, List, Optional, Tuple, Union
-
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from sys import getsizeof
+from typing import Callable, Dict, Any, List, Optional, Tuple, Union
+
+import numpy as np
 import streamlit as st
 import pandas as pd
 
 import yaml
 from pydantic import BaseModel, Field
-from rapidfuzz import fuzz
+from rapidfuzz import fuzz, process
 from PyPDF2 import PdfReader, PdfWriter
 
-from pdf2image import convert_from_bytes
+from pdf2image import convert_from_bytes, convert_from_path
 import pytesseract
 from PIL import Image
 
@@ -73,6 +87,10 @@ STRINGS = {
         "local_ocr": "Local OCR (Tesseract)",
         "extract_text": "Extract text (PyPDF2)",
         "render_pdf": "Render PDF preview",
+        "preview_mode": "Preview mode",
+        "preview_paged": "Page images",
+        "preview_embedded": "Embedded PDF",
+        "preview_page": "Preview page",
         "download_trimmed": "Download trimmed PDF",
         "danger_zone": "Danger Zone",
         "clear_session": "Clear session state",
@@ -124,6 +142,47 @@ STRINGS = {
         "filter_results": "Filter results",
         "loaded_rows": "Loaded rows",
         "standardization_report": "Standardization report",
+        "lineage": "Predicate Lineage",
+        "ancestors": "Ancestors (predicates)",
+        "descendants": "Descendants (cite this device)",
+        "lineage_depth": "Max depth",
+        "max_in_flight": "Max concurrent requests",
+        "ocr_workers": "OCR workers",
+        "ocr_cache_stats": "OCR: {pages} page(s) · {native} from text layer · {cached} from cache · {recognized} recognized",
+        "hybrid_ocr": "Auto (text layer + OCR where needed)",
+        "hybrid_backend": "OCR for scanned pages",
+        "adaptive_dpi": "Adaptive DPI",
+        "grayscale": "Grayscale",
+        "binarize": "Binarize",
+        "crop_margins": "Crop margins",
+        "ocr_render_stats": "Render: {dpi} dpi · {megapixels} MP (vs {megapixels_at_default_dpi} MP at {default_dpi} dpi) · {seconds_per_page} s/page",
+        "ocr_payload": "Vision payload",
+        "pages_per_request": "Pages per request",
+        "token_budget": "Max input tokens per call",
+        "input_tokens": "Input ≈ {tokens} tokens",
+        "input_over_budget": "Input ≈ {tokens} tokens: over budget, will run per page-chunk and merge",
+        "chunks": "chunks",
+        "min_overlap": "Trigram prefilter: min. share of query trigrams (0 = full scan)",
+        "min_overlap_help": "Datasets over 5,000 rows only score rows sharing this share of the query's trigrams. Higher is faster but can skip misspelled matches.",
+        "prefix_cache": "Prompt-prefix caching (SKILL.md sent as a shared cacheable prefix)",
+        "doc_in_prefix": "Share the input document across agents (sent as a user message before agent instructions)",
+        "cached_tokens": "cached",
+        "truncated": "output truncated ({reason})",
+        "pipeline_mode": "Pipeline mode (run several agents)",
+        "pipeline_agents": "Agents to run (dependencies from depends_on are added automatically)",
+        "run_pipeline": "Run pipeline",
+        "pipeline_done": "Pipeline finished: {n}/{total} agents in {seconds}s",
+        "pipeline_rerun_parents": "Re-run upstream agents that already have an output",
+        "pipeline_reused": "Reused edited output of: {agents}",
+        "llm_cache": "LLM cache",
+        "llm_cache_enable": "Reuse cached LLM responses",
+        "force_refresh": "Force refresh (ignore cached answers)",
+        "clear_llm_cache": "Clear LLM cache",
+        "ocr_force_refresh": "Re-OCR cached pages",
+        "clear_ocr_cache": "Clear OCR cache",
+        "cache_hits": "hit",
+        "cache_misses": "miss",
+        "ocr_requests": "{requests} request(s), {batch_fallbacks} batch fallback(s)",
     },
     "zh-TW": {
         "app_title": "FDA 510(k) 審查工作室 — 法規指揮中心",
@@ -174,6 +233,10 @@ STRINGS = {
         "local_ocr": "本機 OCR（Tesseract）",
         "extract_text": "文字擷取（PyPDF2）",
         "render_pdf": "顯示 PDF 預覽",
+        "preview_mode": "預覽模式",
+        "preview_paged": "逐頁影像",
+        "preview_embedded": "內嵌 PDF",
+        "preview_page": "預覽頁",
         "download_trimmed": "下載裁切 PDF",
         "danger_zone": "危險區",
         "clear_session": "清除 session 狀態",
@@ -225,6 +288,47 @@ STRINGS = {
         "filter_results": "篩選結果",
         "loaded_rows": "已載入筆數",
         "standardization_report": "標準化報告",
+        "lineage": "前案譜系（Predicate Lineage）",
+        "ancestors": "上游（前案）",
+        "descendants": "下游（引用此案者）",
+        "lineage_depth": "最大層數",
+        "max_in_flight": "最大並行請求數",
+        "ocr_workers": "OCR 並行工作數",
+        "ocr_cache_stats": "OCR：共 {pages} 頁 · 文字層 {native} 頁 · 快取 {cached} 頁 · 新辨識 {recognized} 頁",
+        "hybrid_ocr": "自動（文字層 + 必要時 OCR）",
+        "hybrid_backend": "掃描頁使用的 OCR",
+        "adaptive_dpi": "自適應 DPI",
+        "grayscale": "灰階",
+        "binarize": "二值化",
+        "crop_margins": "裁切邊界",
+        "ocr_render_stats": "渲染：{dpi} dpi · {megapixels} MP（固定 {default_dpi} dpi 為 {megapixels_at_default_dpi} MP）· 每頁 {seconds_per_page} 秒",
+        "ocr_payload": "Vision 傳輸量",
+        "pages_per_request": "每次請求頁數",
+        "token_budget": "每次呼叫輸入 token 上限",
+        "input_tokens": "輸入約 {tokens} tokens",
+        "input_over_budget": "輸入約 {tokens} tokens：超過上限，將依頁面分段執行後合併",
+        "chunks": "分段",
+        "min_overlap": "三字元預篩：查詢三字元最低共用比例（0 = 全表掃描）",
+        "min_overlap_help": "超過 5,000 列的資料集只比對共用此比例查詢三字元的列。數值越高越快，但可能略過拼字錯誤的結果。",
+        "prefix_cache": "提示前綴快取（SKILL.md 作為共用可快取前綴送出）",
+        "doc_in_prefix": "跨代理共用輸入文件（以使用者訊息置於代理指示之前）",
+        "cached_tokens": "快取",
+        "truncated": "輸出被截斷（{reason}）",
+        "pipeline_mode": "管線模式（一次執行多個代理）",
+        "pipeline_agents": "要執行的代理（depends_on 相依代理會自動加入）",
+        "run_pipeline": "執行管線",
+        "pipeline_done": "管線完成：{n}/{total} 個代理，耗時 {seconds} 秒",
+        "pipeline_rerun_parents": "重新執行已有輸出的上游代理",
+        "pipeline_reused": "沿用已編輯輸出：{agents}",
+        "llm_cache": "LLM 快取",
+        "llm_cache_enable": "重複使用已快取的 LLM 回應",
+        "force_refresh": "強制重新產生（忽略快取）",
+        "clear_llm_cache": "清除 LLM 快取",
+        "ocr_force_refresh": "重新辨識已快取頁面",
+        "clear_ocr_cache": "清除 OCR 快取",
+        "cache_hits": "命中",
+        "cache_misses": "未命中",
+        "ocr_requests": "{requests} 次請求，{batch_fallbacks} 次批次退回逐頁",
     },
 }
 
@@ -1097,6 +1201,52 @@ DEFAULT_RECALL = [
 ]
 
 
+# -----------------------------
+# Bounded caches
+# -----------------------------
+class BoundedLRUCache:
+    def __init__(self, max_bytes: int, sizeof=getsizeof):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items: "OrderedDict[Any, Tuple[Any, int]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def get(self, key: Any) -> Any:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key: Any, value: Any) -> None:
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self._items[key] = (value, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes and self._items:
+                _, (_, evicted) = self._items.popitem(last=False)
+                self.bytes -= evicted
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+            self.bytes = 0
+
+
 # -----------------------------
 # Highlighting (Coral)
 # -----------------------------
@@ -1124,26 +1274,190 @@ DEFAULT_ONTOLOGY = [
 ]
 
 
-def coral_highlight(text: str, keywords: Optional[List[str]] = None) -> str:
+def _trie_regex(words: List[str]) -> str:
+    # Alternation shaped like a trie: each position walks one branch, and the greedy optional
+    # tail tries the longest keyword first, backing off to shorter ones sharing the prefix.
+    trie: Dict[str, Any] = {}
+    for w in words:
+        node = trie
+        for ch in w:
+            node = node.setdefault(ch, {})
+        node[""] = {}
+
+    def build(node: Dict[str, Any]) -> str:
+        alts = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch]
+        if not alts:
+            return ""
+        body = "(?:" + "|".join(alts) + ")" if (len(alts) > 1 or "" in node) else alts[0]
+        return body + "?" if "" in node else body
+
+    return build(trie)
+
+
+def highlight_keyword_set(keywords: Optional[List[str]] = None) -> Tuple[str, ...]:
+    kws = keywords or DEFAULT_ONTOLOGY
+    return tuple(sorted(set(k.strip().lower() for k in kws if k and k.strip())))
+
+
+@st.cache_resource(show_spinner=False, max_entries=64)
+def compile_highlighter(keyword_set: Tuple[str, ...]) -> Optional[Tuple["re.Pattern[str]", "re.Pattern[str]"]]:
+    # (pattern for lowercased text, IGNORECASE fallback); matching the lowercased copy is several
+    # times faster than IGNORECASE because the regex engine can prefilter on the first character.
+    if not keyword_set:
+        return None
+    src = _trie_regex(list(keyword_set))
+    return re.compile(src), re.compile(src, re.IGNORECASE)
+
+
+def keyword_spans(text: str, keyword_set: Tuple[str, ...]) -> List[Tuple[int, int]]:
+    compiled = compile_highlighter(keyword_set)
+    if not text or compiled is None:
+        return []
+    lowered = text.lower()
+    if len(lowered) == len(text):
+        return [m.span() for m in compiled[0].finditer(lowered)]
+    return [m.span() for m in compiled[1].finditer(text)]
+
+
+def normalize_color_pairs(keyword_color_pairs: Optional[List[Tuple[str, str]]]) -> Tuple[Tuple[str, str], ...]:
+    # User keywords are case-sensitive; when a keyword is listed twice the last color wins.
+    colors: Dict[str, str] = {}
+    for kw, color in keyword_color_pairs or []:
+        kw = (kw or "").strip()
+        if kw:
+            colors[kw] = color
+    return tuple(sorted(colors.items()))
+
+
+@st.cache_resource(show_spinner=False, max_entries=64)
+def compile_user_highlighter(user_keywords: Tuple[str, ...]) -> Optional["re.Pattern[str]"]:
+    if not user_keywords:
+        return None
+    return re.compile(_trie_regex(list(user_keywords)))
+
+
+def render_highlights(text: str, keyword_set: Tuple[str, ...], color_pairs: Tuple[Tuple[str, str], ...] = ()) -> str:
+    # Precedence: user keywords win over ontology keywords; an ontology match overlapping any
+    # user match is dropped. Within each set the leftmost, then longest, match wins.
     if not text:
         return ""
-    kws = keywords or DEFAULT_ONTOLOGY
-    kws = sorted(set([k.strip() for k in kws if k and k.strip()]), key=len, reverse=True)
-    out = text
+    colors = dict(color_pairs)
+    user_pattern = compile_user_highlighter(tuple(colors))
+    user = [(m.start(), m.end(), colors[m.group(0)]) for m in user_pattern.finditer(text)] if user_pattern else []
+
+    spans: List[Tuple[int, int, Optional[str]]] = list(user)
+    j = 0
+    for s, e in keyword_spans(text, keyword_set):
+        while j < len(user) and user[j][1] <= s:
+            j += 1
+        if j < len(user) and user[j][0] < e:
+            continue
+        spans.append((s, e, None))
+    spans.sort()
+
+    out, pos = [], 0
+    for s, e, color in spans:
+        out.append(text[pos:s])
+        if color is None:
+            out.append(f'<span class="coral"><b>{text[s:e]}</b></span>')
+        else:
+            out.append(f'<span style="color:{color}; font-weight:900; text-shadow:0 0 18px rgba(255,255,255,0.08)">{text[s:e]}</span>')
+        pos = e
+    out.append(text[pos:])
+    return "".join(out)
 
-    def repl(m):
-        w = m.group(0)
-        return f'<span class="coral"><b>{w}</b></span>'
 
-    for k in kws:
-        pattern = re.compile(rf"(?i)({re.escape(k)})")
-        out = pattern.sub(repl, out)
-    return out
+RENDER_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+
+@st.cache_resource(show_spinner=False)
+def render_cache() -> BoundedLRUCache:
+    return BoundedLRUCache(RENDER_CACHE_MAX_BYTES)
+
+
+def highlight_html(text: str, keyword_set: Tuple[str, ...], color_pairs: Tuple[Tuple[str, str], ...] = ()) -> str:
+    # Content-addressed: unchanged agent outputs/reports are never re-highlighted, edited ones miss.
+    key = (hashlib.sha256(text.encode("utf-8", "surrogatepass")).hexdigest(), keyword_set, color_pairs)
+    cache = render_cache()
+    html = cache.get(key)
+    if html is None:
+        html = render_highlights(text, keyword_set, color_pairs)
+        cache.put(key, html)
+    return html
+
+
+def coral_highlight(text: str, keywords: Optional[List[str]] = None) -> str:
+    if not text:
+        return ""
+    return highlight_html(text, highlight_keyword_set(keywords))
 
 
 # -----------------------------
 # Search engine
 # -----------------------------
+SEARCH_COLUMNS = {
+    "510k": ["k_number", "device_name", "applicant", "manufacturer_name", "product_code", "summary"],
+    "adr": ["adverse_event_id", "brand_name", "manufacturer_name", "product_code", "udi_di", "device_problem", "narrative"],
+    "gudid": ["udi_di", "primary_di", "brand_name", "manufacturer_name", "product_code", "device_description", "gmdn_term"],
+    "recall": ["recall_number", "firm_name", "manufacturer_name", "product_code", "reason_for_recall", "product_description"],
+}
+
+
+# Exact-key hash indexes: identifier-shaped queries are answered from these before fuzzy search.
+KEY_COLUMNS = {
+    "510k": ["k_number", "product_code"],
+    "adr": ["adverse_event_id", "udi_di", "recall_number_link", "product_code"],
+    "gudid": ["udi_di", "primary_di", "product_code"],
+    "recall": ["recall_number", "product_code"],
+}
+IDENTIFIER_PATTERNS = [
+    ("k_number", re.compile(r"^K\d{6}$")),
+    ("udi_di", re.compile(r"^\d{8,14}$")),
+    ("recall_number", re.compile(r"^Z-\d{4}-\d{4}$")),
+    ("adverse_event_id", re.compile(r"^MDR-\d{4}-\d+$")),
+    ("product_code", re.compile(r"^[A-Z]{3}$")),
+]
+# Three letters is also an ordinary word or acronym (ECG, MRI), so product-code hits are merged
+# ahead of the fuzzy results instead of replacing them.
+AMBIGUOUS_IDENTIFIERS = {"product_code"}
+IDENTIFIER_LOOKUPS = {
+    "k_number": {"510k": ["k_number"]},
+    "udi_di": {"adr": ["udi_di"], "gudid": ["udi_di", "primary_di"]},
+    "recall_number": {"adr": ["recall_number_link"], "recall": ["recall_number"]},
+    "adverse_event_id": {"adr": ["adverse_event_id"]},
+    "product_code": {"510k": ["product_code"], "adr": ["product_code"], "gudid": ["product_code"], "recall": ["product_code"]},
+}
+
+
+def normalize_key(v: Any) -> str:
+    if v is None or (isinstance(v, float) and pd.isna(v)):
+        return ""
+    s = str(v).strip().upper()
+    # CSV loads can turn DIs into integers and drop the GTIN-14 leading zeros.
+    if s.isdigit() and len(s) < 14:
+        s = s.zfill(14)
+    return s
+
+
+def detect_identifier(query: str) -> Optional[str]:
+    q = (query or "").strip().upper()
+    for kind, pattern in IDENTIFIER_PATTERNS:
+        if pattern.match(q):
+            return kind
+    return None
+
+
+# Trigram candidate pruning: only rows sharing at least min_overlap of the query's n-grams are
+# fuzzy-scored. This is a heuristic prefilter (heavily misspelled matches can be skipped); 0 turns it
+# off. Small datasets are always scanned in full.
+NGRAM_SIZE = 3
+NGRAM_MIN_OVERLAP = 0.34
+NGRAM_MIN_ROWS = 5000
+
+# search_all / device_360_view results, keyed on (query, dataset versions), LRU-evicted.
+QUERY_CACHE_SIZE = 128
+
+
 @dataclass
 class SearchResult:
     dataset: str
@@ -1151,103 +1465,421 @@ class SearchResult:
     record: Dict[str, Any]
 
 
-class RegulatorySearchEngine:
-    def __init__(self, df_510k: pd.DataFrame, df_adr: pd.DataFrame, df_gudid: pd.DataFrame, df_recall: pd.DataFrame):
-        self.df_510k = df_510k
-        self.df_adr = df_adr
-        self.df_gudid = df_gudid
-        self.df_recall = df_recall
+def char_ngrams(s: str, n: int = NGRAM_SIZE) -> set:
+    return {s[i : i + n] for i in range(len(s) - n + 1)}
+
+
+NGRAM_HASH_MOD = 4294967291  # largest prime below 2**32
+
+
+def ngram_codes(codepoints: np.ndarray, n: int = NGRAM_SIZE) -> np.ndarray:
+    # Code points are < 2**21, so an n-gram packs exactly into one int64 for n <= 3; it is then hashed
+    # to 32 bits so (gram, row) fits one int64 sort key. A collision can only add candidates.
+    m = len(codepoints) - n + 1
+    if m <= 0:
+        return np.empty(0, dtype=np.int64)
+    codes = codepoints[:m].copy()
+    for k in range(1, n):
+        codes = (codes << 21) | codepoints[k : k + m]
+    return codes % NGRAM_HASH_MOD
+
+
+def codepoints(text: str) -> np.ndarray:
+    return np.frombuffer(text.encode("utf-32-le", "surrogatepass"), dtype=np.uint32).astype(np.int64)
+
+
+class NgramIndex:
+    # Postings as one sorted (gram, row) array pair, built with numpy over each column's joined text.
+    def __init__(self, columns: List[np.ndarray], n_rows: int, n: int = NGRAM_SIZE):
+        self.n = n
+        self.n_rows = n_rows
+        row_ids = np.arange(n_rows)
+        keys = [np.empty(0, dtype=np.int64)]
+        for col in columns:
+            owner = np.repeat(row_ids, np.fromiter(map(len, col), dtype=np.int64, count=n_rows))
+            codes = ngram_codes(codepoints("".join(col)), n)
+            # Drop grams spanning two rows' values.
+            ok = owner[: len(codes)] == owner[n - 1 :]
+            keys.append((codes[ok] << 32) | owner[: len(codes)][ok])
+        # Sorted, de-duplicated (gram, row) pairs; each gram's rows are one contiguous slice.
+        # (An in-place sort plus a diff mask is much faster here than np.unique.)
+        pairs = np.concatenate(keys)
+        pairs.sort()
+        pairs = pairs[np.concatenate(([True], pairs[1:] != pairs[:-1]))]
+        self.rows = pairs & 0xFFFFFFFF
+        grams = pairs >> 32
+        starts = np.flatnonzero(np.concatenate(([True], grams[1:] != grams[:-1])))
+        self.grams = grams[starts]
+        self.offsets = np.append(starts, len(pairs))
+
+    def candidates(self, q: str, min_overlap: float = NGRAM_MIN_OVERLAP) -> Optional[np.ndarray]:
+        codes = np.unique(ngram_codes(codepoints(q), self.n))
+        if not len(codes):
+            return None
+        pos = np.searchsorted(self.grams, codes)
+        found = pos[(pos < len(self.grams)) & (self.grams[np.minimum(pos, len(self.grams) - 1)] == codes)] if len(self.grams) else pos[:0]
+        if not len(found):
+            return np.empty(0, dtype=np.int64)
+        need = max(1, math.ceil(len(codes) * min_overlap))
+        lists = [self.rows[self.offsets[i] : self.offsets[i + 1]] for i in found]
+        counts = np.bincount(np.concatenate(lists), minlength=self.n_rows)
+        return np.flatnonzero(counts >= need)
+
+
+def as_k_list(v: Any) -> List[str]:
+    if v is None or (isinstance(v, float) and pd.isna(v)):
+        return []
+    if isinstance(v, (list, tuple, np.ndarray)):
+        items = list(v)
+    else:
+        items = re.split(r"[;,]+", str(v))
+    return [k for k in (normalize_key(x) for x in items) if k]
+
+
+class PredicateGraph:
+    def __init__(self, df: pd.DataFrame):
+        self.parents: Dict[str, List[str]] = {}
+        self.children: Dict[str, List[str]] = {}
+        self.row_of: Dict[str, int] = {}
+        if "k_number" not in df.columns:
+            return
+        preds = df["predicate_k_numbers"].tolist() if "predicate_k_numbers" in df.columns else [None] * len(df)
+        for i, (k, p) in enumerate(zip(df["k_number"].tolist(), preds)):
+            k = normalize_key(k)
+            if not k:
+                continue
+            self.row_of.setdefault(k, i)
+            parents = self.parents.setdefault(k, [])
+            for pk in as_k_list(p):
+                if pk != k and pk not in parents:
+                    parents.append(pk)
+                    self.children.setdefault(pk, []).append(k)
+
+    def traverse(self, k_number: str, direction: str = "ancestors", max_depth: Optional[int] = None) -> List[Tuple[str, int, str]]:
+        edges = self.parents if direction == "ancestors" else self.children
+        start = normalize_key(k_number)
+        seen, frontier, out, depth = {start}, [start], [], 0
+        while frontier and (max_depth is None or depth < max_depth):
+            depth += 1
+            nxt = []
+            for node in frontier:
+                for nb in edges.get(node, []):
+                    if nb not in seen:
+                        seen.add(nb)
+                        out.append((nb, depth, node))
+                        nxt.append(nb)
+            frontier = nxt
+        return out
+
+
+class DatasetIndex:
+    def __init__(
+        self,
+        df: Optional[pd.DataFrame],
+        cols: Optional[List[str]] = None,
+        key_cols: Optional[List[str]] = None,
+        min_rows: int = NGRAM_MIN_ROWS,
+    ):
+        self.df = df if df is not None else pd.DataFrame()
+        self.min_rows = min_rows
+        self._lowered: Dict[str, np.ndarray] = {}
+        self._ngrams: Dict[Tuple[str, ...], NgramIndex] = {}
+        self._keys: Dict[str, Dict[str, List[int]]] = {}
+        self._graph: Optional[PredicateGraph] = None
+        for c in cols or []:
+            self.column(c)
+        for c in key_cols or []:
+            self.key_index(c)
+
+    def __len__(self) -> int:
+        return len(self.df)
+
+    def column(self, c: str) -> np.ndarray:
+        if c not in self._lowered:
+            if c in self.df.columns:
+                vals = [str(v).lower() for v in self.df[c].tolist()]
+            else:
+                vals = [""] * len(self.df)
+            self._lowered[c] = np.asarray(vals, dtype=object)
+        return self._lowered[c]
 
-    def _fuzzy_hits(self, df: pd.DataFrame, cols: List[str], query: str, min_score=75, limit=25):
+    def ngram_index(self, cols: List[str]) -> Optional[NgramIndex]:
+        # Built on the first query that uses it, not when the dataset is loaded.
+        if len(self.df) < self.min_rows:
+            return None
+        key = tuple(cols)
+        if key not in self._ngrams:
+            self._ngrams[key] = NgramIndex([self.column(c) for c in cols], len(self.df))
+        return self._ngrams[key]
+
+    def key_index(self, c: str) -> Dict[str, List[int]]:
+        if c not in self._keys:
+            keys: Dict[str, List[int]] = {}
+            if c in self.df.columns:
+                for i, v in enumerate(self.df[c].tolist()):
+                    k = normalize_key(v)
+                    if k:
+                        keys.setdefault(k, []).append(i)
+            self._keys[c] = keys
+        return self._keys[c]
+
+    def lookup(self, cols: List[str], key: str) -> List[int]:
+        k = normalize_key(key)
+        seen, out = set(), []
+        for c in cols:
+            for i in self.key_index(c).get(k, []):
+                if i not in seen:
+                    seen.add(i)
+                    out.append(i)
+        return out
+
+    def predicate_graph(self) -> PredicateGraph:
+        if self._graph is None:
+            self._graph = PredicateGraph(self.df)
+        return self._graph
+
+    def records(self, positions) -> List[Dict[str, Any]]:
+        return self.df.iloc[list(positions)].to_dict(orient="records")
+
+    def fuzzy_hits(
+        self,
+        cols: List[str],
+        query: str,
+        min_score=75,
+        limit=25,
+        stats: Optional[Dict[str, Any]] = None,
+        min_overlap: float = NGRAM_MIN_OVERLAP,
+    ) -> List[Tuple[float, Dict[str, Any]]]:
         q = (query or "").strip().lower()
-        hits = []
-        if not q or df is None or df.empty:
-            return hits
-        for _, row in df.iterrows():
-            best = 0
-            for c in cols:
-                val = str(row.get(c, "")).lower()
-                if not val:
-                    continue
-                best = max(best, fuzz.partial_ratio(q, val))
-            if best >= min_score:
-                hits.append((best, row.to_dict()))
-        hits.sort(key=lambda x: x[0], reverse=True)
-        return hits[:limit]
+        if not q or self.df.empty:
+            return []
+        n_rows = len(self.df)
+        ng = self.ngram_index(cols) if min_overlap > 0 else None
+        cand = ng.candidates(q, min_overlap) if ng is not None else None
+        if cand is not None and len(cand) < limit:
+            # Too few candidates to fill the page: fall back to a full scan rather than return a short list.
+            cand = None
+        if stats is not None:
+            stats.update(
+                {
+                    "rows": n_rows,
+                    "candidates": n_rows if cand is None else len(cand),
+                    "pruning_ratio": 0.0 if cand is None else 1.0 - len(cand) / n_rows,
+                }
+            )
+
+        best = np.zeros(n_rows if cand is None else len(cand), dtype=np.float64)
+        for c in cols:
+            choices = self.column(c) if cand is None else self.column(c)[cand]
+            scores = process.cdist([q], choices, scorer=fuzz.partial_ratio, score_cutoff=min_score, dtype=np.float64, workers=-1)[0]
+            np.maximum(best, scores, out=best)
+        hit_idx = np.flatnonzero(best >= min_score)
+        order = hit_idx[np.argsort(-best[hit_idx], kind="stable")][:limit]
+        rows = order if cand is None else cand[order]
+        return [(float(best[i]), rec) for i, rec in zip(order, self.records(rows))]
+
+
+DEFAULT_FINGERPRINT = "default"
+
 
-    def search_all(self, query: str) -> Dict[str, List[SearchResult]]:
+def dataset_fingerprint(df: Optional[pd.DataFrame]) -> str:
+    if df is None or df.empty:
+        return "empty"
+    h = hashlib.sha256()
+    h.update("\x1f".join(map(str, df.columns)).encode("utf-8"))
+    h.update(pd.util.hash_pandas_object(df.astype(str), index=False).values.tobytes())
+    return h.hexdigest()[:20]
+
+
+class RegulatorySearchEngine:
+    def __init__(
+        self,
+        df_510k: pd.DataFrame,
+        df_adr: pd.DataFrame,
+        df_gudid: pd.DataFrame,
+        df_recall: pd.DataFrame,
+        fingerprints: Optional[Dict[str, str]] = None,
+        base: Optional["RegulatorySearchEngine"] = None,
+    ):
+        self.indexes: Dict[str, DatasetIndex] = {}
+        self.fingerprints: Dict[str, str] = {}
+        self.versions: Dict[str, int] = {}
+        self._lock = threading.RLock()
+        self._query_cache: "OrderedDict[Tuple[Any, ...], Any]" = OrderedDict()
+        if base is not None:
+            # Start from another engine's indexes; sync() only rebuilds datasets whose fingerprint differs.
+            self.indexes.update(base.indexes)
+            self.fingerprints.update(base.fingerprints)
+            self.versions.update(base.versions)
+        self.sync(df_510k, df_adr, df_gudid, df_recall, fingerprints)
+
+    def sync(
+        self,
+        df_510k: pd.DataFrame,
+        df_adr: pd.DataFrame,
+        df_gudid: pd.DataFrame,
+        df_recall: pd.DataFrame,
+        fingerprints: Optional[Dict[str, str]] = None,
+    ) -> List[str]:
+        # Rebuild only the datasets that were replaced (by fingerprint when given, else by DataFrame identity).
+        fingerprints = fingerprints or {}
+        rebuilt = []
+        with self._lock:
+            for name, df in [("510k", df_510k), ("adr", df_adr), ("gudid", df_gudid), ("recall", df_recall)]:
+                cur = self.indexes.get(name)
+                fp = fingerprints.get(name)
+                changed = cur is None or (self.fingerprints.get(name) != fp if fp else cur.df is not df)
+                if changed:
+                    self.indexes[name] = DatasetIndex(df, SEARCH_COLUMNS[name], KEY_COLUMNS[name])
+                    self.versions[name] = self.versions.get(name, 0) + 1
+                    rebuilt.append(name)
+                    if name == "510k":
+                        self.indexes[name].predicate_graph()
+                if fp:
+                    self.fingerprints[name] = fp
+            if rebuilt:
+                self._query_cache.clear()
+        return rebuilt
+
+    @property
+    def df_510k(self) -> pd.DataFrame:
+        return self.indexes["510k"].df
+
+    @property
+    def df_adr(self) -> pd.DataFrame:
+        return self.indexes["adr"].df
+
+    @property
+    def df_gudid(self) -> pd.DataFrame:
+        return self.indexes["gudid"].df
+
+    @property
+    def df_recall(self) -> pd.DataFrame:
+        return self.indexes["recall"].df
+
+    def _cached(self, kind: str, query: str, compute, *extra):
+        with self._lock:
+            key = (kind, (query or "").strip(), *extra, tuple(sorted(self.versions.items())))
+            if key in self._query_cache:
+                self._query_cache.move_to_end(key)
+                return self._query_cache[key]
+        value = compute()
+        with self._lock:
+            self._query_cache[key] = value
+            while len(self._query_cache) > QUERY_CACHE_SIZE:
+                self._query_cache.popitem(last=False)
+        return value
+
+    def _fuzzy_hits(self, dataset: str, cols: List[str], query: str, min_score=75, limit=25, stats: Optional[Dict[str, Any]] = None, min_overlap: float = NGRAM_MIN_OVERLAP):
+        return self.indexes[dataset].fuzzy_hits(cols, query, min_score=min_score, limit=limit, stats=stats, min_overlap=min_overlap)
+
+    def exact_hits(self, kind: str, key: str, limit=25) -> Dict[str, List[Dict[str, Any]]]:
+        out: Dict[str, List[Dict[str, Any]]] = {}
+        for name, cols in IDENTIFIER_LOOKUPS.get(kind, {}).items():
+            pos = self.indexes[name].lookup(cols, key)
+            if pos:
+                out[name] = self.indexes[name].records(pos[:limit])
+        return out
+
+    def search_all(self, query: str, min_overlap: float = NGRAM_MIN_OVERLAP) -> Dict[str, List[SearchResult]]:
+        return self._cached("search", query, lambda: self._search_all(query, min_overlap), min_overlap)[0]
+
+    def search_stats(self, query: str, min_overlap: float = NGRAM_MIN_OVERLAP) -> Dict[str, Dict[str, Any]]:
+        return self._cached("search", query, lambda: self._search_all(query, min_overlap), min_overlap)[1]
+
+    def _search_all(self, query: str, min_overlap: float = NGRAM_MIN_OVERLAP) -> Tuple[Dict[str, List[SearchResult]], Dict[str, Dict[str, Any]]]:
         results: Dict[str, List[SearchResult]] = {"510k": [], "adr": [], "gudid": [], "recall": []}
+        stats: Dict[str, Dict[str, Any]] = {}
         if not (query or "").strip():
-            return results
-
-        for score, rec in self._fuzzy_hits(
-            self.df_510k,
-            ["k_number", "device_name", "applicant", "manufacturer_name", "product_code", "summary"],
-            query,
-        ):
-            results["510k"].append(SearchResult("510k", score, rec))
-
-        for score, rec in self._fuzzy_hits(
-            self.df_adr,
-            ["adverse_event_id", "brand_name", "manufacturer_name", "product_code", "udi_di", "device_problem", "narrative"],
-            query,
-        ):
-            results["adr"].append(SearchResult("adr", score, rec))
-
-        for score, rec in self._fuzzy_hits(
-            self.df_gudid,
-            ["udi_di", "primary_di", "brand_name", "manufacturer_name", "product_code", "device_description", "gmdn_term"],
-            query,
-        ):
-            results["gudid"].append(SearchResult("gudid", score, rec))
-
-        for score, rec in self._fuzzy_hits(
-            self.df_recall,
-            ["recall_number", "firm_name", "manufacturer_name", "product_code", "reason_for_recall", "product_description"],
-            query,
-        ):
-            results["recall"].append(SearchResult("recall", score, rec))
-
-        q_upper = (query or "").strip().upper()
-        top_k = None
-        for r in results["510k"]:
-            if str(r.record.get("k_number", "")).upper() == q_upper:
-                top_k = r.record
-                break
-        if top_k:
-            preds = top_k.get("predicate_k_numbers", []) or []
-            for k in preds:
-                for score, rec in self._fuzzy_hits(self.df_510k, ["k_number", "device_name"], k, min_score=88, limit=10):
-                    results["510k"].append(SearchResult("510k", score, rec))
+            return results, stats
+
+        kind = detect_identifier(query)
+        exact = self.exact_hits(kind, query) if kind else {}
+        if exact and kind not in AMBIGUOUS_IDENTIFIERS:
+            for name, recs in exact.items():
+                results[name] = [SearchResult(name, 100, rec) for rec in recs]
+                n_rows = max(1, len(self.indexes[name]))
+                stats[name] = {"rows": n_rows, "candidates": len(recs), "pruning_ratio": 1.0 - len(recs) / n_rows}
+            if kind == "k_number":
+                preds = results["510k"][0].record.get("predicate_k_numbers", []) or []
+                for k in preds:
+                    for rec in self.exact_hits("k_number", k, limit=10).get("510k", []):
+                        results["510k"].append(SearchResult("510k", 100, rec))
+            return results, stats
+
+        key = normalize_key(query)
+        for name in ["510k", "adr", "gudid", "recall"]:
+            stats[name] = {}
+            results[name] = [SearchResult(name, 100, rec) for rec in exact.get(name, [])]
+            for score, rec in self._fuzzy_hits(name, SEARCH_COLUMNS[name], query, stats=stats[name], min_overlap=min_overlap):
+                if name in exact and normalize_key(rec.get(kind)) == key:
+                    continue
+                results[name].append(SearchResult(name, score, rec))
+            del results[name][25:]
+
+        return results, stats
+
+    def predicate_lineage(self, k_number: str, direction: str = "ancestors", max_depth: Optional[int] = 5) -> List[Dict[str, Any]]:
+        ix = self.indexes["510k"]
+        graph = ix.predicate_graph()
+        steps = graph.traverse(k_number, direction=direction, max_depth=max_depth)
+        found = [graph.row_of[k] for k, _, _ in steps if k in graph.row_of]
+        by_pos = dict(zip(found, ix.records(found)))
+        out = []
+        for k, depth, via in steps:
+            rec = by_pos.get(graph.row_of.get(k), {})
+            out.append(
+                {
+                    "depth": depth,
+                    "k_number": k,
+                    "via": via,
+                    "device_name": rec.get("device_name"),
+                    "applicant": rec.get("applicant"),
+                    "decision_date": rec.get("decision_date"),
+                    "product_code": rec.get("product_code"),
+                    "in_dataset": bool(rec),
+                }
+            )
+        return out
 
-        return results
+    def device_360_view(self, query: str, min_overlap: float = NGRAM_MIN_OVERLAP) -> Dict[str, Any]:
+        return self._cached("360", query, lambda: self._device_360_view(query, min_overlap), min_overlap)
 
-    def device_360_view(self, query: str) -> Dict[str, Any]:
-        r = self.search_all(query)
+    def _device_360_view(self, query: str, min_overlap: float = NGRAM_MIN_OVERLAP) -> Dict[str, Any]:
+        r = self.search_all(query, min_overlap)
         top_510k = r["510k"][0].record if r["510k"] else None
         product_code = (top_510k or {}).get("product_code")
         device_name = (top_510k or {}).get("device_name")
 
         recalls, mdrs, gudid = [], [], []
+        recall_classes: List[Any] = []
+        mdr_count = 0
         if product_code:
-            recalls = [x.record for x in r["recall"] if x.record.get("product_code") == product_code]
-            mdrs = [x.record for x in r["adr"] if x.record.get("product_code") == product_code]
-            gudid = [x.record for x in r["gudid"] if x.record.get("product_code") == product_code]
+            recall_ix, adr_ix, gudid_ix = self.indexes["recall"], self.indexes["adr"], self.indexes["gudid"]
+            recall_pos = recall_ix.lookup(["product_code"], product_code)
+            mdr_pos = adr_ix.lookup(["product_code"], product_code)
+            recalls = recall_ix.records(recall_pos[:8])
+            mdrs = adr_ix.records(mdr_pos[:6])
+            gudid = gudid_ix.records(gudid_ix.lookup(["product_code"], product_code)[:6])
+            mdr_count = len(mdr_pos)
+            if "recall_class" in recall_ix.df.columns:
+                recall_classes = recall_ix.df["recall_class"].iloc[recall_pos].tolist()
         if (not product_code) and device_name:
             recalls = [x.record for x in r["recall"]][:8]
             mdrs = [x.record for x in r["adr"]][:8]
             gudid = [x.record for x in r["gudid"]][:8]
+            mdr_count = len(mdrs)
+            recall_classes = [rr.get("recall_class") for rr in recalls]
 
         top_recall_class = None
-        if recalls:
+        if recall_classes:
             priority = {"I": 3, "II": 2, "III": 1}
-            recalls_sorted = sorted(recalls, key=lambda rr: priority.get(str(rr.get("recall_class", "")).upper(), 0), reverse=True)
-            top_recall_class = recalls_sorted[0].get("recall_class")
+            top_recall_class = sorted(recall_classes, key=lambda c: priority.get(str(c or "").upper(), 0), reverse=True)[0]
 
         return {
             "top_510k": top_510k,
             "recalls": recalls[:8],
-            "mdr_count": len(mdrs),
+            "mdr_count": mdr_count,
             "mdr_examples": mdrs[:6],
             "gudid_examples": gudid[:6],
             "top_recall_class": top_recall_class,
@@ -1267,6 +1899,7 @@ class AgentDef(BaseModel):
     max_tokens: int = 4000
     system_prompt: str
     user_prompt: str = "Analyze the provided content."
+    depends_on: List[str] = Field(default_factory=list)
 
 
 class AgentsConfig(BaseModel):
@@ -1291,6 +1924,8 @@ def load_and_standardize_agents_yaml(raw_text: str) -> AgentsConfig:
         a.setdefault("max_tokens", 4000)
         a.setdefault("description", "")
         a.setdefault("user_prompt", "Analyze the provided content.")
+        deps = a.get("depends_on") or []
+        a["depends_on"] = [deps] if isinstance(deps, str) else [str(d) for d in deps]
         fixed.append(a)
     data["agents"] = fixed
     return AgentsConfig.model_validate(data)
@@ -1319,6 +1954,118 @@ def env_or_session(env_name: str) -> Optional[str]:
     return st.session_state.get("api_keys", {}).get(env_name)
 
 
+# SDK clients are pooled per (provider, key hash, base_url, options) so HTTP keep-alive connections
+# survive across agent runs, magics, dataset summaries and OCR. Rotated keys simply get a new entry;
+# entries unused for CLIENT_IDLE_SECONDS are dropped, and a key rejected with 401/403 is purged.
+XAI_BASE_URL = "https://api.x.ai/v1"
+CLIENT_IDLE_SECONDS = 15 * 60
+AGENT_STREAM_REPAINT_SECONDS = 0.1
+
+# genai.configure() is process-global; configuring and binding a transport must not interleave.
+GEMINI_CONFIGURE_LOCK = threading.Lock()
+
+
+class GeminiKeyedClient:
+    def __init__(self, api_key: str):
+        import google.generativeai as genai
+        from google.generativeai import client as genai_client
+
+        self.api_key = api_key
+        with GEMINI_CONFIGURE_LOCK:
+            genai.configure(api_key=api_key)
+            self._transport = genai_client.get_default_generative_client()
+
+    def model(self, model_name: str, generation_config: Dict[str, Any]):
+        import google.generativeai as genai
+
+        # google-generativeai has no public per-client key; GenerativeModel keeps its transport in the
+        # private _client slot (filled lazily from the global default). Pin it to this key's transport
+        # so a later configure() from another session can't swap it. If a future SDK drops the slot,
+        # re-configure under the lock instead: still correct for this call, but racy across sessions.
+        m = genai.GenerativeModel(model_name=model_name, generation_config=generation_config)
+        if hasattr(m, "_client"):
+            m._client = self._transport
+        else:
+            with GEMINI_CONFIGURE_LOCK:
+                genai.configure(api_key=self.api_key)
+        return m
+
+
+class ClientPool:
+    def __init__(self, idle_seconds: float = CLIENT_IDLE_SECONDS):
+        self.idle_seconds = idle_seconds
+        self._clients: Dict[Tuple, Tuple[Any, float]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(provider: str, api_key: str, base_url: Optional[str], options: Dict[str, Any]) -> Tuple:
+        return (provider, hashlib.sha256(api_key.encode("utf-8")).hexdigest(), base_url, tuple(sorted(options.items())))
+
+    def get(self, provider: str, api_key: str, base_url: Optional[str] = None, **options) -> Any:
+        key = self._key(provider, api_key, base_url, options)
+        now = time.time()
+        with self._lock:
+            stale = [self._clients.pop(k)[0] for k, (_, used) in list(self._clients.items()) if now - used > self.idle_seconds]
+            item = self._clients.get(key)
+            if item is not None:
+                self._clients[key] = (item[0], now)
+        self._close(stale)
+        if item is not None:
+            return item[0]
+
+        # Building a client can be slow (TLS setup, SDK imports); don't hold up other lookups meanwhile.
+        client = self._create(provider, api_key, base_url, options)
+        with self._lock:
+            item = self._clients.get(key)
+            if item is None:
+                self._clients[key] = (client, now)
+                return client
+            self._clients[key] = (item[0], now)
+        self._close([client])
+        return item[0]
+
+    def discard_key(self, api_key: str) -> None:
+        digest = hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+        with self._lock:
+            dropped = [self._clients.pop(k)[0] for k in [k for k in self._clients if k[1] == digest]]
+        self._close(dropped)
+
+    @staticmethod
+    def _close(clients: List[Any]) -> None:
+        # OpenAI/Anthropic clients own an httpx connection pool; Gemini transports are SDK-managed.
+        for client in clients:
+            close = getattr(client, "close", None)
+            if callable(close):
+                try:
+                    close()
+                except Exception:
+                    pass
+
+    @staticmethod
+    def _create(provider: str, api_key: str, base_url: Optional[str], options: Dict[str, Any]) -> Any:
+        if provider == "openai":
+            from openai import OpenAI
+
+            return OpenAI(api_key=api_key, base_url=base_url, **options)
+        if provider == "anthropic":
+            import anthropic
+
+            return anthropic.Anthropic(api_key=api_key, base_url=base_url, **options)
+        if provider == "gemini":
+            return GeminiKeyedClient(api_key)
+        raise ValueError(f"Unsupported provider: {provider}")
+
+
+@st.cache_resource(show_spinner=False)
+def llm_client_pool() -> ClientPool:
+    return ClientPool()
+
+
+def llm_cache_key(provider: str, model: str, temperature: float, max_tokens: int, system: str, user: str) -> str:
+    digest = lambda text: hashlib.sha256((text or "").encode("utf-8", "surrogatepass")).hexdigest()
+    return json.dumps([(provider or "").lower().strip(), model, float(temperature), int(max_tokens), digest(system), digest(user)])
+
+
 def call_llm_text(
     provider: str,
     model: str,
@@ -1327,40 +2074,222 @@ def call_llm_text(
     user: str,
     max_tokens: int = 12000,
     temperature: float = 0.2,
+    on_chunk: Optional[Callable[[str], None]] = None,
+    stats: Optional[Dict[str, Any]] = None,
+    cache: Optional["DiskCache"] = None,
+    force_refresh: bool = False,
+    cache_prefix: Optional[str] = None,
+    cache_document: Optional[str] = None,
+) -> str:
+    # With on_chunk the completion is streamed: on_chunk receives each text delta as it arrives and
+    # stats gets ttft_s (time to first token) and total_s. The full text is returned either way.
+    # With cache, identical requests are answered from disk unless force_refresh is set.
+    # cache_prefix and cache_document lead the request as a provider-cacheable prefix (see openai_input);
+    # token usage lands in stats.
+    # Only complete, non-empty answers are written to cache; truncated ones are recomputed next time.
+    started = time.perf_counter()
+    key_system = f"{cache_prefix}\x00{system}" if cache_prefix else system
+    key_user = f"{cache_document}\x00{user}" if cache_document else user
+    key = llm_cache_key(provider, model, temperature, max_tokens, key_system, key_user) if cache is not None else None
+    if key is not None and not force_refresh:
+        hit = cache.get(key)
+        if hit is not None:
+            if on_chunk is not None:
+                on_chunk(hit)
+            if stats is not None:
+                stats.update({"cache": "hit", "ttft_s": 0.0, "total_s": round(time.perf_counter() - started, 2)})
+            return hit
+    outcome: Dict[str, Any] = {}
+    try:
+        if on_chunk is None:
+            out = _call_llm_text(provider, model, api_key, system, user, max_tokens=max_tokens, temperature=temperature, cache_prefix=cache_prefix, cache_document=cache_document, stats=outcome)
+        else:
+            parts: List[str] = []
+            stream = _stream_llm_text(provider, model, api_key, system, user, max_tokens=max_tokens, temperature=temperature, cache_prefix=cache_prefix, cache_document=cache_document, stats=outcome)
+            for chunk in stream:
+                if not chunk:
+                    continue
+                if not parts and stats is not None:
+                    stats["ttft_s"] = round(time.perf_counter() - started, 2)
+                parts.append(chunk)
+                on_chunk(chunk)
+            out = "".join(parts)
+            if (provider or "").lower().strip() in ("gemini", "anthropic"):
+                out = out.strip()
+        if stats is not None:
+            stats["total_s"] = round(time.perf_counter() - started, 2)
+            merge_call_stats(stats, outcome)
+        if key is not None:
+            if out.strip() and "truncated" not in outcome:
+                cache.put(key, out)
+            if stats is not None:
+                stats["cache"] = "refresh" if force_refresh else "miss"
+        return out
+    except Exception as e:
+        if error_status(e) in (401, 403):
+            llm_client_pool().discard_key(api_key)
+        raise
+
+
+def llm_cache_kwargs() -> Dict[str, Any]:
+    # Session's LLM cache settings as call_llm_text kwargs; call from the script thread only.
+    if not st.session_state["llm_cache_enabled"]:
+        return {}
+    return {"cache": llm_response_cache(), "force_refresh": st.session_state["llm_force_refresh"]}
+
+
+# Prompt-prefix caching. Providers cache identical leading tokens (OpenAI/xAI/Gemini automatically,
+# Anthropic up to a cache_control breakpoint), and only from about 1024 tokens on. Requests are laid
+# out from most to least shared: SKILL.md (cache_prefix) as system, then the input document
+# (cache_document, untrusted, so always user role), then the agent's own system prompt and the user
+# prompt. Every agent run over the same document then reuses the SKILL.md + document prefix.
+USAGE_LOCK = threading.Lock()
+CACHE_BREAKPOINT = {"type": "ephemeral"}
+
+
+def openai_input(system: str, user: str, cache_prefix: Optional[str] = None, cache_document: Optional[str] = None) -> List[Dict[str, str]]:
+    messages = [{"role": "system", "content": cache_prefix}] if cache_prefix else []
+    if cache_document:
+        messages.append({"role": "user", "content": cache_document})
+    if system or not (cache_prefix or cache_document):
+        messages.append({"role": "system", "content": system})
+    messages.append({"role": "user", "content": user})
+    return messages
+
+
+def anthropic_system(system: str, cache_prefix: Optional[str] = None, cache_document: Optional[str] = None) -> Union[str, List[Dict[str, Any]]]:
+    # With a document the agent system prompt moves into the final user turn (see anthropic_messages),
+    # since Anthropic's system blocks always precede every message.
+    if not cache_prefix:
+        return "" if cache_document else system
+    blocks = [{"type": "text", "text": cache_prefix}]
+    if system and not cache_document:
+        blocks.append({"type": "text", "text": system})
+    # The breakpoint caches everything up to and including the last system block.
+    blocks[-1]["cache_control"] = CACHE_BREAKPOINT
+    return blocks
+
+
+def anthropic_messages(system: str, user: str, cache_document: Optional[str] = None) -> List[Dict[str, Any]]:
+    if not cache_document:
+        return [{"role": "user", "content": user}]
+    blocks = [{"type": "text", "text": cache_document, "cache_control": CACHE_BREAKPOINT}]
+    if system:
+        blocks.append({"type": "text", "text": system})
+    blocks.append({"type": "text", "text": user})
+    return [{"role": "user", "content": blocks}]
+
+
+def gemini_contents(system: str, user: str, cache_prefix: Optional[str] = None, cache_document: Optional[str] = None) -> List[str]:
+    if not cache_prefix and not cache_document:
+        return [system, user]
+    return [p for p in (cache_prefix, cache_document, system) if p] + [user]
+
+
+def record_usage(stats: Optional[Dict[str, Any]], provider: str, usage: Any) -> None:
+    # Adds to stats["input_tokens" / "cached_tokens" / "cache_write_tokens"].
+    if stats is None or usage is None:
+        return
+    if provider == "anthropic":
+        cached = getattr(usage, "cache_read_input_tokens", 0) or 0
+        written = getattr(usage, "cache_creation_input_tokens", 0) or 0
+        total = (getattr(usage, "input_tokens", 0) or 0) + cached + written
+    elif provider == "gemini":
+        cached = getattr(usage, "cached_content_token_count", 0) or 0
+        written = 0
+        total = getattr(usage, "prompt_token_count", 0) or 0
+    else:
+        cached = getattr(getattr(usage, "input_tokens_details", None), "cached_tokens", 0) or 0
+        written = 0
+        total = getattr(usage, "input_tokens", 0) or 0
+    for k, v in (("input_tokens", total), ("cached_tokens", cached), ("cache_write_tokens", written)):
+        stats[k] = stats.get(k, 0) + int(v)
+
+
+def merge_call_stats(stats: Dict[str, Any], outcome: Dict[str, Any]) -> None:
+    # One call's usage and finish status into stats, which may be shared by concurrent map calls.
+    with USAGE_LOCK:
+        for k, v in outcome.items():
+            stats[k] = stats.get(k, 0) + v if k in ("input_tokens", "cached_tokens", "cache_write_tokens") else v
+
+
+LLM_BLOCKED_REASONS = {"CONTENT_FILTER", "REFUSAL", "SAFETY", "RECITATION", "BLOCKLIST", "PROHIBITED_CONTENT", "SPII"}
+LLM_TRUNCATED_REASONS = {"MAX_OUTPUT_TOKENS", "MAX_TOKENS", "LENGTH"}
+
+
+def note_finish(stats: Optional[Dict[str, Any]], provider: str, reason: Any) -> None:
+    # Provider stop reasons: safety/refusal stops raise, output-limit stops set stats["truncated"].
+    reason = getattr(reason, "name", reason)
+    if reason is None:
+        return
+    if str(reason).upper() in LLM_BLOCKED_REASONS:
+        raise RuntimeError(f"{provider} stopped the response: {reason}")
+    if str(reason).upper() in LLM_TRUNCATED_REASONS and stats is not None:
+        stats["truncated"] = str(reason)
+
+
+def openai_finish(stats: Optional[Dict[str, Any]], provider: str, resp: Any) -> None:
+    status = getattr(resp, "status", None)
+    if status == "failed":
+        raise RuntimeError(f"{provider} response failed: {getattr(getattr(resp, 'error', None), 'message', None) or 'unknown error'}")
+    if status == "incomplete":
+        note_finish(stats, provider, getattr(getattr(resp, "incomplete_details", None), "reason", None) or "max_output_tokens")
+
+
+def gemini_finish(stats: Optional[Dict[str, Any]], r: Any) -> None:
+    block = getattr(getattr(r, "prompt_feedback", None), "block_reason", None)
+    if block:
+        raise RuntimeError(f"gemini blocked the prompt: {getattr(block, 'name', block)}")
+    candidates = getattr(r, "candidates", None) or []
+    if candidates:
+        note_finish(stats, "gemini", getattr(candidates[0], "finish_reason", None))
+
+
+def _call_llm_text(
+    provider: str,
+    model: str,
+    api_key: str,
+    system: str,
+    user: str,
+    max_tokens: int = 12000,
+    temperature: float = 0.2,
+    cache_prefix: Optional[str] = None,
+    cache_document: Optional[str] = None,
+    stats: Optional[Dict[str, Any]] = None,
 ) -> str:
     provider = (provider or "").lower().strip()
+    pool = llm_client_pool()
 
     if provider == "openai":
-        from openai import OpenAI
-
-        client = OpenAI(api_key=api_key)
+        client = pool.get("openai", api_key)
         resp = client.responses.create(
             model=model,
-            input=[{"role": "system", "content": system}, {"role": "user", "content": user}],
+            input=openai_input(system, user, cache_prefix, cache_document),
             max_output_tokens=max_tokens,
             temperature=temperature,
         )
+        record_usage(stats, provider, getattr(resp, "usage", None))
+        openai_finish(stats, provider, resp)
         return resp.output_text or ""
 
     if provider == "gemini":
-        import google.generativeai as genai
-
-        genai.configure(api_key=api_key)
-        m = genai.GenerativeModel(model_name=model, generation_config={"temperature": temperature, "max_output_tokens": max_tokens})
-        r = m.generate_content([system, user])
+        m = pool.get("gemini", api_key).model(model, {"temperature": temperature, "max_output_tokens": max_tokens})
+        r = m.generate_content(gemini_contents(system, user, cache_prefix, cache_document))
+        record_usage(stats, provider, getattr(r, "usage_metadata", None))
+        gemini_finish(stats, r)
         return (r.text or "").strip()
 
     if provider == "anthropic":
-        import anthropic
-
-        client = anthropic.Anthropic(api_key=api_key)
+        client = pool.get("anthropic", api_key)
         msg = client.messages.create(
             model=model,
             max_tokens=max_tokens,
             temperature=temperature,
-            system=system,
-            messages=[{"role": "user", "content": user}],
+            system=anthropic_system(system, cache_prefix, cache_document),
+            messages=anthropic_messages(system, user, cache_document),
         )
+        record_usage(stats, provider, getattr(msg, "usage", None))
+        note_finish(stats, provider, getattr(msg, "stop_reason", None))
         parts = []
         for b in msg.content:
             if getattr(b, "type", "") == "text":
@@ -1368,66 +2297,636 @@ def call_llm_text(
         return "".join(parts).strip()
 
     if provider == "xai":
-        from openai import OpenAI
-
-        client = OpenAI(api_key=api_key, base_url="https://api.x.ai/v1")
+        client = pool.get("openai", api_key, base_url=XAI_BASE_URL)
         resp = client.responses.create(
             model=model,
-            input=[{"role": "system", "content": system}, {"role": "user", "content": user}],
+            input=openai_input(system, user, cache_prefix, cache_document),
             max_output_tokens=max_tokens,
             temperature=temperature,
         )
+        record_usage(stats, provider, getattr(resp, "usage", None))
+        openai_finish(stats, provider, resp)
         return resp.output_text or ""
 
     raise ValueError(f"Unsupported provider: {provider}")
 
 
-def call_vision_ocr(provider: str, model: str, api_key: str, images: List[Image.Image], lang: str, max_tokens: int = 12000) -> str:
+def _stream_llm_text(
+    provider: str,
+    model: str,
+    api_key: str,
+    system: str,
+    user: str,
+    max_tokens: int = 12000,
+    temperature: float = 0.2,
+    cache_prefix: Optional[str] = None,
+    cache_document: Optional[str] = None,
+    stats: Optional[Dict[str, Any]] = None,
+):
+    provider = (provider or "").lower().strip()
+    pool = llm_client_pool()
+
+    if provider in ("openai", "xai"):
+        client = pool.get("openai", api_key, base_url=XAI_BASE_URL if provider == "xai" else None)
+        stream = client.responses.create(
+            model=model,
+            input=openai_input(system, user, cache_prefix, cache_document),
+            max_output_tokens=max_tokens,
+            temperature=temperature,
+            stream=True,
+        )
+        for event in stream:
+            kind = getattr(event, "type", "")
+            if kind == "response.output_text.delta":
+                yield event.delta
+            elif kind in ("response.completed", "response.incomplete", "response.failed"):
+                record_usage(stats, provider, getattr(event.response, "usage", None))
+                openai_finish(stats, provider, event.response)
+            elif kind == "error":
+                raise RuntimeError(f"{provider} stream error: {getattr(event, 'message', None) or getattr(event, 'code', None) or 'unknown error'}")
+        return
+
+    if provider == "gemini":
+        m = pool.get("gemini", api_key).model(model, {"temperature": temperature, "max_output_tokens": max_tokens})
+        last = None
+        for chunk in m.generate_content(gemini_contents(system, user, cache_prefix, cache_document), stream=True):
+            last = chunk
+            try:
+                yield chunk.text
+            except ValueError:
+                # Chunks without text parts (e.g. a trailing finish/safety chunk) raise on .text.
+                continue
+        record_usage(stats, provider, getattr(last, "usage_metadata", None))
+        if last is not None:
+            gemini_finish(stats, last)
+        return
+
+    if provider == "anthropic":
+        client = pool.get("anthropic", api_key)
+        with client.messages.stream(
+            model=model,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            system=anthropic_system(system, cache_prefix, cache_document),
+            messages=anthropic_messages(system, user, cache_document),
+        ) as stream:
+            for text in stream.text_stream:
+                yield text
+            final = stream.get_final_message()
+            record_usage(stats, provider, getattr(final, "usage", None))
+            note_finish(stats, provider, getattr(final, "stop_reason", None))
+        return
+
+    raise ValueError(f"Unsupported provider: {provider}")
+
+
+# -----------------------------
+# Concurrent provider calls (rate limits + retries)
+# -----------------------------
+VISION_MAX_IN_FLIGHT = 4
+VISION_BATCH_PAGES = 1
+VISION_BATCH_MAX_PAGES = 8
+VISION_BATCH_MAX_MEGAPIXELS = 16.0
+VISION_BATCH_MAX_OUTPUT_TOKENS = 32000
+PROVIDER_RPM = {"openai": 500, "gemini": 150, "anthropic": 50, "xai": 60}
+RETRY_ATTEMPTS = 4
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+
+
+class RateLimiter:
+    # Spaces request starts evenly to stay under a requests-per-minute budget.
+    def __init__(self, rpm: Optional[int]):
+        self.interval = 60.0 / rpm if rpm else 0.0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+@st.cache_resource(show_spinner=False)
+def provider_rate_limiter(provider: str) -> RateLimiter:
+    return RateLimiter(PROVIDER_RPM.get(provider))
+
+
+def error_status(e: Exception) -> Optional[int]:
+    for status in (getattr(e, "status_code", None), getattr(getattr(e, "response", None), "status_code", None), getattr(e, "code", None)):
+        if isinstance(status, int):
+            return status
+    return None
+
+
+def is_retryable_error(e: Exception) -> bool:
+    status = error_status(e)
+    if status is not None:
+        return status == 429 or status >= 500
+    return type(e).__name__ in {"APIConnectionError", "APITimeoutError", "ResourceExhausted", "ServiceUnavailable", "DeadlineExceeded"}
+
+
+def retry_after_seconds(e: Exception) -> Optional[float]:
+    headers = getattr(getattr(e, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def call_with_retries(fn: Callable[[], Any], limiter: Optional[RateLimiter] = None, attempts: int = RETRY_ATTEMPTS) -> Any:
+    for attempt in range(attempts):
+        if limiter is not None:
+            limiter.wait()
+        try:
+            return fn()
+        except Exception as e:
+            if attempt == attempts - 1 or not is_retryable_error(e):
+                raise
+            delay = retry_after_seconds(e) or min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)
+            time.sleep(delay * random.uniform(0.8, 1.2))
+
+
+def run_concurrently(
+    items: List[Any],
+    fn: Callable[[Any], Any],
+    max_in_flight: int = VISION_MAX_IN_FLIGHT,
+    limiter: Optional[RateLimiter] = None,
+    progress: Optional[Callable[[int, int], None]] = None,
+) -> List[Any]:
+    # Results come back in input order; progress(done, total) is called from the caller's thread.
+    results: List[Any] = [None] * len(items)
+    if not items:
+        return results
+    with ThreadPoolExecutor(max_workers=max(1, min(max_in_flight, len(items)))) as pool:
+        futures = {pool.submit(call_with_retries, (lambda it=it: fn(it)), limiter): i for i, it in enumerate(items)}
+        for done, fut in enumerate(as_completed(futures), start=1):
+            results[futures[fut]] = fut.result()
+            if progress:
+                progress(done, len(items))
+    return results
+
+
+def join_ocr_pages(texts: List[str]) -> str:
+    return "\n".join(f"\n\n--- PAGE {i} ---\n{txt}" for i, txt in enumerate(texts, start=1)).strip()
+
+
+BATCH_PAGE_MARKER = re.compile(r"^[ \t]*=+[ \t]*PAGE[ \t]+(\d+)[ \t]*=+[ \t]*$", re.MULTILINE)
+
+
+def split_batch_output(text: str, n_pages: int) -> Optional[List[str]]:
+    # Expects "=== PAGE k ===" headers for k = 1..n in order; anything else means the batch is retried page by page.
+    marks = list(BATCH_PAGE_MARKER.finditer(text or ""))
+    if [int(m.group(1)) for m in marks] != list(range(1, n_pages + 1)):
+        return None
+    bounds = [m.end() for m in marks]
+    ends = [m.start() for m in marks[1:]] + [len(text)]
+    return [text[s:e].strip() for s, e in zip(bounds, ends)]
+
+
+class PartialText(str):
+    # OCR text from a response that hit its output limit: usable for this run, never cached.
+    pass
+
+
+def vision_ocr_request(
+    provider: str,
+    model: str,
+    api_key: str,
+    lang: str,
+    max_tokens: int = 12000,
+    payload_sizes: Optional[List[int]] = None,
+) -> Callable[[List[Image.Image]], str]:
+    # One request per call: a single page gets the plain OCR prompt, several pages get a delimited-output prompt.
+    # max_tokens is the per-page output budget; batches get it once per page, up to VISION_BATCH_MAX_OUTPUT_TOKENS.
     provider = (provider or "").lower().strip()
     sys = "You are an OCR engine for regulatory PDFs. Preserve tables when possible. Output plain text (no markdown)."
     if lang == "zh-TW":
         sys = "你是法規 PDF 的 OCR 引擎。盡可能保留表格結構與數值。輸出純文字（不要 Markdown）。"
 
-    prompt = "Extract all readable text from this page. Preserve tables and headings."
-    if lang == "zh-TW":
-        prompt = "請從此頁影像擷取所有可讀文字，盡可能保留表格與標題結構。"
+    def prompt_for(n: int) -> str:
+        if n == 1:
+            if lang == "zh-TW":
+                return "請從此頁影像擷取所有可讀文字，盡可能保留表格與標題結構。"
+            return "Extract all readable text from this page. Preserve tables and headings."
+        if lang == "zh-TW":
+            return (
+                f"以下依序提供 {n} 張頁面影像。請逐頁擷取所有可讀文字，盡可能保留表格與標題結構。"
+                f"每頁輸出前請單獨一行寫上 === PAGE k ===（k 為 1 到 {n}），不得省略任何一頁，空白頁也要輸出標記。"
+            )
+        return (
+            f"You are given {n} page images in order. Extract all readable text from each page, preserving tables and headings. "
+            f"Start each page's output with a line containing exactly === PAGE k === (k = 1 to {n}); never skip a page, "
+            "emit the marker even for blank pages."
+        )
+
+    def output_tokens(n: int) -> int:
+        return max_tokens if n == 1 else min(VISION_BATCH_MAX_OUTPUT_TOKENS, max_tokens * n)
+
+    def encoded(images: List[Image.Image]) -> List[Tuple[str, bytes]]:
+        out = [encode_image_compact(img) for img in images]
+        if payload_sizes is not None:
+            payload_sizes.extend(len(data) for _, data in out)
+        return out
 
-    chunks = []
     if provider == "openai":
-        from openai import OpenAI
+        client = llm_client_pool().get("openai", api_key, max_retries=0)
 
-        client = OpenAI(api_key=api_key)
-        for i, img in enumerate(images, start=1):
-            buf = io.BytesIO()
-            img.save(buf, format="PNG")
-            b64 = base64.b64encode(buf.getvalue()).decode("utf-8")
-            data_url = f"data:image/png;base64,{b64}"
+        def ocr_openai(images: List[Image.Image]) -> str:
+            content = [{"type": "input_text", "text": prompt_for(len(images))}]
+            for mime, data in encoded(images):
+                b64 = base64.b64encode(data).decode("utf-8")
+                content.append({"type": "input_image", "image_url": f"data:{mime};base64,{b64}"})
 
             resp = client.responses.create(
                 model=model,
                 input=[
                     {"role": "system", "content": sys},
-                    {"role": "user", "content": [{"type": "input_text", "text": prompt}, {"type": "input_image", "image_url": data_url}]},
+                    {"role": "user", "content": content},
                 ],
-                max_output_tokens=max_tokens,
+                max_output_tokens=output_tokens(len(images)),
                 temperature=0.0,
             )
-            chunks.append(f"\n\n--- PAGE {i} ---\n{(resp.output_text or '').strip()}")
-        return "\n".join(chunks).strip()
+            finish: Dict[str, Any] = {}
+            openai_finish(finish, "openai", resp)
+            text = (resp.output_text or "").strip()
+            return PartialText(text) if "truncated" in finish else text
+
+        return ocr_openai
 
     if provider == "gemini":
-        import google.generativeai as genai
+        m = llm_client_pool().get("gemini", api_key).model(model, {"temperature": 0.0, "max_output_tokens": max_tokens})
 
-        genai.configure(api_key=api_key)
-        m = genai.GenerativeModel(model_name=model, generation_config={"temperature": 0.0, "max_output_tokens": max_tokens})
-        for i, img in enumerate(images, start=1):
-            r = m.generate_content([sys + "\n" + prompt, img])
-            chunks.append(f"\n\n--- PAGE {i} ---\n{(r.text or '').strip()}")
-        return "\n".join(chunks).strip()
+        def ocr_gemini(images: List[Image.Image]) -> str:
+            parts = [sys + "\n" + prompt_for(len(images))] + [{"mime_type": mime, "data": data} for mime, data in encoded(images)]
+            r = m.generate_content(parts, generation_config={"temperature": 0.0, "max_output_tokens": output_tokens(len(images))})
+            finish: Dict[str, Any] = {}
+            gemini_finish(finish, r)
+            text = (r.text or "").strip()
+            return PartialText(text) if "truncated" in finish else text
+
+        return ocr_gemini
 
     raise ValueError("Vision OCR only supported for provider=openai or gemini in this build.")
 
 
+# -----------------------------
+# Agent input chunking (map-reduce)
+# -----------------------------
+# Inputs over the token budget are split on "--- PAGE i ---" boundaries, the agent runs on each chunk
+# in parallel, and a reduce call merges the partial answers. Page markers travel with every chunk and
+# chunk outputs are labelled with their page range, so [p. i] citations survive the merge.
+AGENT_INPUT_TOKEN_BUDGET = 48000
+AGENT_MAP_MAX_IN_FLIGHT = 4
+OCR_PAGE_MARKER = re.compile(r"^--- PAGE (\d+) ---[ \t]*$", re.MULTILINE)
+CJK_CHARS = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]")
+
+
+def estimate_tokens(text: str) -> int:
+    # Provider-agnostic estimate: ~1 token per CJK character, ~4 characters per token otherwise.
+    text = text or ""
+    cjk = len(CJK_CHARS.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def split_ocr_pages(text: str) -> List[Tuple[Optional[int], str]]:
+    marks = list(OCR_PAGE_MARKER.finditer(text or ""))
+    if not marks:
+        return [(None, text or "")]
+    out = []
+    head = text[: marks[0].start()].strip()
+    if head:
+        out.append((None, head))
+    ends = [m.start() for m in marks[1:]] + [len(text)]
+    for m, end in zip(marks, ends):
+        out.append((int(m.group(1)), text[m.start() : end].strip()))
+    return out
+
+
+def split_oversized(body: str, budget: int) -> List[str]:
+    parts, current = [], ""
+    for para in body.split("\n\n"):
+        while estimate_tokens(para) > budget:
+            step = max(1, int(len(para) * budget / estimate_tokens(para)))
+            if current:
+                parts.append(current)
+                current = ""
+            parts.append(para[:step])
+            para = para[step:]
+        candidate = f"{current}\n\n{para}" if current else para
+        if current and estimate_tokens(candidate) > budget:
+            parts.append(current)
+            candidate = para
+        current = candidate
+    if current:
+        parts.append(current)
+    return parts
+
+
+def page_label(pages: List[Optional[int]], lang: str = "en") -> str:
+    numbered = [p for p in pages if p is not None]
+    if not numbered:
+        return "前言" if lang == "zh-TW" else "front matter"
+    lo, hi = min(numbered), max(numbered)
+    return f"p. {lo}" if lo == hi else f"p. {lo}-{hi}"
+
+
+def chunk_agent_input(text: str, budget: int, lang: str = "en") -> List[Tuple[str, str]]:
+    pieces: List[Tuple[Optional[int], str]] = []
+    for page_no, body in split_ocr_pages(text):
+        if estimate_tokens(body) <= budget:
+            pieces.append((page_no, body))
+            continue
+        for i, part in enumerate(split_oversized(body, budget - 20)):
+            if i and page_no is not None:
+                part = f"--- PAGE {page_no} --- (cont.)\n{part}"
+            pieces.append((page_no, part))
+
+    chunks: List[Tuple[str, str]] = []
+    group: List[Tuple[Optional[int], str]] = []
+    size = 0
+    for page_no, body in pieces:
+        n = estimate_tokens(body) + 1
+        if group and size + n > budget:
+            chunks.append((page_label([p for p, _ in group], lang), "\n\n".join(b for _, b in group)))
+            group, size = [], 0
+        group.append((page_no, body))
+        size += n
+    if group:
+        chunks.append((page_label([p for p, _ in group], lang), "\n\n".join(b for _, b in group)))
+    return chunks
+
+
+def map_chunk_prompt(user_prompt: str, chunk: str, k: int, n: int, label: str, lang: str = "en") -> str:
+    if lang == "zh-TW":
+        note = f"（這是長文件的第 {k}/{n} 部分，範圍 {label}。只分析這一部分；每個發現都要依 '--- PAGE i ---' 標記以 [p. i] 註明頁碼。）"
+    else:
+        note = f"(This is part {k} of {n} of a longer document, covering {label}. Analyze only this part and cite the '--- PAGE i ---' page of every finding as [p. i].)"
+    return f"{user_prompt}\n\n{note}\n\n---\nINPUT:\n{chunk}"
+
+
+def reduce_chunks_prompt(user_prompt: str, labelled: List[Tuple[str, str]], lang: str = "en") -> str:
+    merged = "\n\n".join(f"### {label}\n{out}" for label, out in labelled)
+    if lang == "zh-TW":
+        note = (
+            f"（文件過長，已分成 {len(labelled)} 部分分析。以下為各部分結果，均標示頁碼範圍。請依上述指示合併為一份完整輸出："
+            "去除重複、保留所有 [p. i] 頁碼引用、衝突處須註明，不得加入部分結果中沒有的事實。）"
+        )
+        header = "部分結果"
+    else:
+        note = (
+            f"(The document was too long for one request and was analyzed in {len(labelled)} parts. Below are the partial results, "
+            "each labelled with its page range. Merge them into one complete answer following the instructions above: remove duplicates, "
+            "keep every [p. i] citation, flag conflicts, and do not add facts that are not in the partial results.)"
+        )
+        header = "PARTIAL RESULTS"
+    return f"{user_prompt}\n\n{note}\n\n---\n{header}:\n{merged}"
+
+
+def run_agent_call(
+    provider: str,
+    model: str,
+    api_key: str,
+    system: str,
+    user_prompt: str,
+    agent_input: str,
+    max_tokens: int = 12000,
+    temperature: float = 0.2,
+    token_budget: int = AGENT_INPUT_TOKEN_BUDGET,
+    lang: str = "en",
+    on_chunk: Optional[Callable[[str], None]] = None,
+    stats: Optional[Dict[str, Any]] = None,
+    progress: Optional[Callable[[int, int], None]] = None,
+    cache_prefix: Optional[str] = None,
+    cache_document: bool = False,
+    **llm_kwargs,
+) -> str:
+    # cache_prefix (typically SKILL.md) is shared by every agent; with cache_document a direct call sends the
+    # input as a user message right after it, so every agent run over the same document shares the prefix.
+    user_prompt = (user_prompt or "").strip()
+    limiter = provider_rate_limiter((provider or "").lower().strip())
+    call = lambda user, document=None, **kw: call_llm_text(provider, model, api_key, system, user, max_tokens=max_tokens, temperature=temperature, cache_prefix=cache_prefix, cache_document=document, **kw, **llm_kwargs)
+    prefix_tokens = estimate_tokens(cache_prefix or "")
+
+    full_user = f"{user_prompt}\n\n---\nINPUT:\n{agent_input}"
+    if prefix_tokens + estimate_tokens(system) + estimate_tokens(full_user) <= token_budget:
+        document = None
+        if cache_document:
+            document = f"INPUT:\n{agent_input}"
+            note = "（輸入文件已附於上方 INPUT 訊息。）" if lang == "zh-TW" else "(The input document is provided above under INPUT.)"
+            full_user = f"{user_prompt}\n\n{note}".strip()
+        if on_chunk is not None:
+            return call(full_user, document, on_chunk=on_chunk, stats=stats)
+        return call_with_retries(lambda: call(full_user, document, stats=stats), limiter)
+
+    chunk_budget = max(1000, token_budget - prefix_tokens - estimate_tokens(system) - estimate_tokens(user_prompt) - 500)
+    chunks = chunk_agent_input(agent_input, chunk_budget, lang)
+    prompts = [map_chunk_prompt(user_prompt, body, k, len(chunks), label, lang) for k, (label, body) in enumerate(chunks, start=1)]
+    # Map/reduce calls share the cacheable prefix; their token usage is folded into stats at the end.
+    map_stats: Dict[str, Any] = {}
+    map_call = lambda user: call(user, stats=map_stats)
+    outputs = run_concurrently(prompts, map_call, max_in_flight=AGENT_MAP_MAX_IN_FLIGHT, limiter=limiter, progress=progress)
+    labelled = [(label, out) for (label, _), out in zip(chunks, outputs)]
+    calls = len(chunks)
+
+    # Partial results that still do not fit are merged in page-ordered groups until they do.
+    while len(labelled) > 1 and estimate_tokens(reduce_chunks_prompt(user_prompt, labelled, lang)) > chunk_budget:
+        groups: List[List[Tuple[str, str]]] = [[]]
+        for item in labelled:
+            if groups[-1] and estimate_tokens(reduce_chunks_prompt(user_prompt, groups[-1] + [item], lang)) > chunk_budget:
+                groups.append([])
+            groups[-1].append(item)
+        if len(groups) == len(labelled):
+            break
+        merged = run_concurrently([reduce_chunks_prompt(user_prompt, g, lang) for g in groups], map_call, max_in_flight=AGENT_MAP_MAX_IN_FLIGHT, limiter=limiter)
+        labelled = [(f"{g[0][0]} … {g[-1][0]}" if len(g) > 1 else g[0][0], out) for g, out in zip(groups, merged)]
+        calls += len(groups)
+
+    final_user = reduce_chunks_prompt(user_prompt, labelled, lang)
+    if on_chunk is not None:
+        out = call(final_user, on_chunk=on_chunk, stats=stats)
+    else:
+        out = call_with_retries(lambda: call(final_user, stats=stats), limiter)
+    if stats is not None:
+        stats.update({"chunks": len(chunks), "llm_calls": calls + 1, "input_tokens_est": estimate_tokens(agent_input)})
+        for k in ("input_tokens", "cached_tokens", "cache_write_tokens"):
+            if k in map_stats:
+                stats[k] = stats.get(k, 0) + map_stats[k]
+        if "truncated" in map_stats:
+            stats.setdefault("truncated", map_stats["truncated"])
+    return out
+
+
+# -----------------------------
+# Agent pipeline (async DAG runner)
+# -----------------------------
+PIPELINE_PROVIDER_CONCURRENCY = {"openai": 4, "gemini": 4, "anthropic": 2, "xai": 2}
+
+
+@dataclass
+class PipelineResult:
+    agent: AgentDef
+    input: str
+    output: str = ""
+    error: Optional[str] = None
+    stats: Dict[str, Any] = field(default_factory=dict)
+
+
+def plan_agent_pipeline(agents: List[AgentDef], selected_ids: List[str], reuse_ids: Optional[set] = None) -> List[AgentDef]:
+    # Selected agents plus everything they depend on, topologically sorted with ties kept in agents.yaml order.
+    # Unselected dependencies in reuse_ids (agents with an existing output) are not planned, nor are their own parents.
+    by_id = {a.id: a for a in agents}
+    order = {a.id: i for i, a in enumerate(agents)}
+    reuse_ids = (reuse_ids or set()) - set(selected_ids)
+    needed, stack = set(), list(selected_ids)
+    while stack:
+        aid = stack.pop()
+        if aid in needed or aid in reuse_ids:
+            continue
+        if aid not in by_id:
+            raise ValueError(f"Unknown agent in depends_on: {aid}")
+        needed.add(aid)
+        stack.extend(by_id[aid].depends_on)
+
+    planned, done = [], set()
+    while len(planned) < len(needed):
+        ready = [aid for aid in needed - done if all(d in done or d in reuse_ids for d in by_id[aid].depends_on)]
+        if not ready:
+            raise ValueError(f"depends_on cycle among: {', '.join(sorted(needed - done))}")
+        for aid in sorted(ready, key=order.get):
+            planned.append(by_id[aid])
+            done.add(aid)
+    return planned
+
+
+def pipeline_input(agent: AgentDef, base_input: str, results: Dict[str, PipelineResult]) -> str:
+    if not agent.depends_on:
+        return base_input
+    if len(agent.depends_on) == 1:
+        return results[agent.depends_on[0]].output
+    return "\n\n".join(f"## {results[d].agent.name} ({d})\n\n{results[d].output}" for d in agent.depends_on)
+
+
+async def run_agent_pipeline(
+    plan: List[AgentDef],
+    base_input: str,
+    run_agent: Callable[[AgentDef, str, Dict[str, Any]], str],
+    limits: Optional[Dict[str, int]] = None,
+    on_done: Optional[Callable[[PipelineResult], None]] = None,
+    reused: Optional[Dict[str, PipelineResult]] = None,
+) -> List[PipelineResult]:
+    # Each agent starts as soon as its parents finish; run_agent is blocking and runs in a worker thread.
+    # reused holds parents that are not re-run (see plan_agent_pipeline); their output feeds children as is.
+    limits = limits or PIPELINE_PROVIDER_CONCURRENCY
+    semaphores = {p: asyncio.Semaphore(max(1, n)) for p, n in limits.items()}
+    results: Dict[str, PipelineResult] = dict(reused or {})
+    finished = {a.id: asyncio.Event() for a in plan}
+
+    async def run_one(agent: AgentDef) -> None:
+        for d in agent.depends_on:
+            if d in finished:
+                await finished[d].wait()
+        failed = [d for d in agent.depends_on if results[d].error]
+        res = PipelineResult(agent=agent, input="")
+        if failed:
+            res.error = f"skipped: upstream failed ({', '.join(failed)})"
+        else:
+            res.input = pipeline_input(agent, base_input, results)
+            sem = semaphores.setdefault(agent.provider, asyncio.Semaphore(1))
+            async with sem:
+                try:
+                    res.output = await asyncio.to_thread(run_agent, agent, res.input, res.stats)
+                except Exception as e:
+                    res.error = str(e)
+        results[agent.id] = res
+        finished[agent.id].set()
+        if on_done is not None:
+            on_done(res)
+
+    await asyncio.gather(*(run_one(a) for a in plan))
+    return [results[a.id] for a in plan]
+
+
+# -----------------------------
+# Session blob store (uploads on disk, memory-mapped)
+# -----------------------------
+CACHE_DIR = os.environ.get("STUDIO_CACHE_DIR") or os.path.join(os.path.expanduser("~"), ".cache", "fda510k_studio")
+SESSION_BLOB_IDLE_SECONDS = 6 * 3600
+SESSION_BLOB_SWEEP_INTERVAL = 600
+
+
+@dataclass(frozen=True)
+class BlobHandle:
+    path: str
+    size: int
+    sha256: str
+
+    def open(self) -> Union[mmap.mmap, io.BytesIO]:
+        if not self.size:
+            return io.BytesIO()
+        with open(self.path, "rb") as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class SessionBlobStore:
+    # One directory per browser session; directories idle longer than idle_seconds are swept.
+    def __init__(self, root: str, idle_seconds: float = SESSION_BLOB_IDLE_SECONDS, sweep_interval: float = SESSION_BLOB_SWEEP_INTERVAL):
+        self.root = root
+        self.idle_seconds = idle_seconds
+        self.sweep_interval = sweep_interval
+        self._last_sweep = 0.0
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def session_dir(self, session_id: str) -> str:
+        return os.path.join(self.root, session_id)
+
+    def put(self, session_id: str, name: str, stream) -> BlobHandle:
+        d = self.session_dir(session_id)
+        os.makedirs(d, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp = tempfile.mkstemp(dir=d)
+        with os.fdopen(fd, "wb") as f:
+            for chunk in iter(lambda: stream.read(1 << 20), b""):
+                digest.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+        path = os.path.join(d, name)
+        os.replace(tmp, path)
+        self.touch(session_id)
+        return BlobHandle(path=path, size=size, sha256=digest.hexdigest())
+
+    def touch(self, session_id: str) -> None:
+        d = self.session_dir(session_id)
+        if os.path.isdir(d):
+            os.utime(d, None)
+        self.sweep()
+
+    def sweep(self, force: bool = False) -> None:
+        now = time.time()
+        with self._lock:
+            if not force and now - self._last_sweep < self.sweep_interval:
+                return
+            self._last_sweep = now
+        for entry in os.scandir(self.root):
+            try:
+                if entry.is_dir() and now - entry.stat().st_mtime > self.idle_seconds:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+            except FileNotFoundError:
+                pass
+
+
+@st.cache_resource(show_spinner=False)
+def session_blob_store() -> SessionBlobStore:
+    return SessionBlobStore(os.path.join(CACHE_DIR, "sessions"))
+
+
 # -----------------------------
 # PDF tools
 # -----------------------------
@@ -1451,25 +2950,84 @@ def parse_page_ranges(ranges_str: str) -> List[Tuple[int, int]]:
     return out
 
 
-def trim_pdf_bytes(pdf_bytes: bytes, page_ranges: List[Tuple[int, int]]) -> bytes:
-    reader = PdfReader(io.BytesIO(pdf_bytes))
-    writer = PdfWriter()
-    n = len(reader.pages)
-
+def expand_page_ranges(page_ranges: List[Tuple[int, int]], n_pages: int) -> List[int]:
+    out = []
     for (s, e) in page_ranges:
-        s = max(1, s)
-        e = min(n, e)
-        for i in range(s - 1, e):
-            writer.add_page(reader.pages[i])
+        out.extend(range(max(1, s), min(n_pages, e) + 1))
+    return out
 
-    out = io.BytesIO()
-    writer.write(out)
-    return out.getvalue()
+
+class PdfDocument:
+    # Parsed once per upload; page texts are extracted on first use and memoized.
+    def __init__(self, source: Union[bytes, BlobHandle]):
+        if isinstance(source, BlobHandle):
+            self.path = source.path
+            self.sha256 = source.sha256
+            self._buf = source.open()
+        else:
+            self.path = None
+            self.sha256 = hashlib.sha256(source).hexdigest()
+            self._buf = io.BytesIO(source)
+        self.reader = PdfReader(self._buf)
+        self._texts: Dict[int, str] = {}
+        self._font_sizes: Dict[int, List[float]] = {}
+        # Deferred downloads materialize pages from a worker thread while reruns keep reading.
+        self._lock = threading.Lock()
+
+    @property
+    def page_count(self) -> int:
+        return len(self.reader.pages)
+
+    def page_text(self, page_no: int) -> str:
+        if page_no not in self._texts:
+            sizes: List[float] = []
+
+            def visit(text, cm, tm, font_dict, font_size):
+                if text.strip() and font_size:
+                    scale = math.sqrt(abs(tm[0] * tm[3] - tm[1] * tm[2]) * abs(cm[0] * cm[3] - cm[1] * cm[2]))
+                    sizes.append(float(font_size) * scale)
+
+            with self._lock:
+                self._texts[page_no] = self.reader.pages[page_no - 1].extract_text(visitor_text=visit) or ""
+            self._font_sizes[page_no] = sizes
+        return self._texts[page_no]
+
+    def page_font_size(self, page_no: int) -> Optional[float]:
+        # Size of the small print (10th percentile, in points); None for pages without a text layer.
+        self.page_text(page_no)
+        sizes = [x for x in self._font_sizes.get(page_no, []) if x > 0]
+        return float(np.percentile(sizes, 10)) if sizes else None
+
+    def page_size(self, page_no: int) -> Tuple[float, float]:
+        with self._lock:
+            box = self.reader.pages[page_no - 1].mediabox
+            return float(box.width), float(box.height)
+
+    def iter_page_texts(self, page_numbers: Optional[List[int]] = None):
+        for page_no in range(1, self.page_count + 1) if page_numbers is None else page_numbers:
+            yield page_no, self.page_text(page_no)
+
+    def extract_text(self, page_numbers: Optional[List[int]] = None) -> str:
+        return "\n\n".join(txt for _, txt in self.iter_page_texts(page_numbers)).strip()
+
+    def read_bytes(self) -> bytes:
+        with self._lock:
+            return self._buf.getvalue() if isinstance(self._buf, io.BytesIO) else self._buf[:]
+
+    def write_pages(self, page_numbers: List[int]) -> bytes:
+        # Page selections stay as index lists over this document; bytes are only built on export.
+        with self._lock:
+            writer = PdfWriter()
+            for page_no in page_numbers:
+                writer.add_page(self.reader.pages[page_no - 1])
+
+            out = io.BytesIO()
+            writer.write(out)
+            return out.getvalue()
 
 
 def extract_text_pypdf2(pdf_bytes: bytes) -> str:
-    reader = PdfReader(io.BytesIO(pdf_bytes))
-    return "\n\n".join([(p.extract_text() or "") for p in reader.pages]).strip()
+    return PdfDocument(pdf_bytes).extract_text()
 
 
 def render_pdf_iframe(pdf_bytes: bytes, height: int = 520) -> str:
@@ -1485,6 +3043,466 @@ def render_pdf_iframe(pdf_bytes: bytes, height: int = 520) -> str:
     """
 
 
+# -----------------------------
+# Persistent disk cache (SQLite)
+# -----------------------------
+class DiskCache:
+    # Small key/value store shared by all sessions; one short-lived connection per call keeps it thread-safe.
+    def __init__(self, path: str, ttl_seconds: Optional[float] = None, max_bytes: Optional[int] = None):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS kv_accessed ON kv (accessed)")
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute("SELECT value, created FROM kv WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.ttl_seconds is not None and now - row[1] > self.ttl_seconds:
+                conn.execute("DELETE FROM kv WHERE key = ?", (key,))
+                row = None
+            if row is None:
+                with self._lock:
+                    self.misses += 1
+                return None
+            conn.execute("UPDATE kv SET accessed = ? WHERE key = ?", (now, key))
+        with self._lock:
+            self.hits += 1
+        return row[0]
+
+    def put(self, key: str, value: str) -> None:
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO kv (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value.encode("utf-8", "surrogatepass")), now, now),
+            )
+            if self.max_bytes is not None:
+                self._evict(conn)
+
+    def _evict(self, conn: sqlite3.Connection) -> None:
+        if self.ttl_seconds is not None:
+            conn.execute("DELETE FROM kv WHERE created < ?", (time.time() - self.ttl_seconds,))
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM kv").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        cutoff, freed = None, 0
+        for accessed, size in conn.execute("SELECT accessed, size FROM kv ORDER BY accessed"):
+            freed += size
+            cutoff = accessed
+            if total - freed <= self.max_bytes:
+                break
+        conn.execute("DELETE FROM kv WHERE accessed <= ?", (cutoff,))
+
+    def clear(self) -> None:
+        with self._connect() as conn:
+            conn.execute("DELETE FROM kv")
+
+
+def open_disk_cache(name: str, ttl_seconds: Optional[float] = None, max_bytes: Optional[int] = None) -> Optional[DiskCache]:
+    try:
+        return DiskCache(os.path.join(CACHE_DIR, name), ttl_seconds=ttl_seconds, max_bytes=max_bytes)
+    except (OSError, sqlite3.Error):
+        return None
+
+
+LLM_CACHE_TTL_SECONDS = 7 * 24 * 3600
+LLM_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+
+@st.cache_resource(show_spinner=False)
+def llm_response_cache() -> Optional[DiskCache]:
+    return open_disk_cache("llm_responses.sqlite", ttl_seconds=LLM_CACHE_TTL_SECONDS, max_bytes=LLM_CACHE_MAX_BYTES)
+
+
+# -----------------------------
+# Page-level OCR (Tesseract / Vision)
+# -----------------------------
+# pdftoppm and tesseract run as their own processes, so a small thread pool driving one page per
+# task keeps every core busy. Each task renders its page only when it starts and drops the image
+# when done, so at most `workers` page images are alive at a time.
+LOCAL_OCR_WORKERS = max(1, (os.cpu_count() or 2) - 1)
+OCR_DPI = 220
+TESSERACT_LANG = "eng"
+OCR_CACHE_MAX_BYTES = 512 * 1024 * 1024
+OCR_CACHE_TTL_SECONDS = 30 * 24 * 3600
+
+# Parallel tesseract processes should not each spin up an OpenMP pool of their own.
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+
+@st.cache_resource(show_spinner=False)
+def ocr_cache() -> Optional[DiskCache]:
+    return open_disk_cache("ocr_pages.sqlite", ttl_seconds=OCR_CACHE_TTL_SECONDS, max_bytes=OCR_CACHE_MAX_BYTES)
+
+
+def render_pdf_page(pdf_path: str, page_no: int, dpi: int = OCR_DPI) -> Image.Image:
+    return convert_from_path(pdf_path, dpi=dpi, first_page=page_no, last_page=page_no)[0]
+
+
+# Render stage: pick a DPI per page so the small print lands around OCR_TARGET_GLYPH_PX tall,
+# then shrink the image (grayscale, optional binarization, margin crop) before it is recognized.
+OCR_MIN_DPI = 150
+OCR_MAX_DPI = 400
+OCR_TARGET_GLYPH_PX = 30
+OCR_MAX_PIXELS = 40_000_000
+OCR_PROBE_DPI = 72
+OCR_PROBE_MIN_LINES = 3
+OCR_PROBE_CACHE = BoundedLRUCache(4096, sizeof=lambda _: 1)
+
+
+@dataclass(frozen=True)
+class OcrRenderOptions:
+    adaptive_dpi: bool = True
+    dpi: int = OCR_DPI
+    grayscale: bool = True
+    binarize: bool = False
+    crop_margins: bool = True
+
+    def tag(self) -> str:
+        return f"{'auto' if self.adaptive_dpi else self.dpi}:{int(self.grayscale)}{int(self.binarize)}{int(self.crop_margins)}"
+
+
+def estimate_scan_font_pt(img: Image.Image, dpi: int) -> Optional[float]:
+    # Row profile of a low-DPI render: runs of inked rows are text lines, their height ~ the font size.
+    gray = img.convert("L")
+    ink = np.asarray(gray) < min(otsu_threshold(gray), 200)
+    if not ink.any():
+        return None
+    inked = ink.sum(axis=1) > max(2, ink.shape[1] // 200)
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], inked.view(np.int8), [0]))))
+    heights = edges[1::2] - edges[::2]
+    heights = heights[(heights >= 3) & (heights <= ink.shape[0] // 8)]
+    if len(heights) < OCR_PROBE_MIN_LINES:
+        return None
+    return float(np.percentile(heights, 10)) * 72.0 / dpi
+
+
+def scan_font_size(doc: PdfDocument, pdf_path: str, page_no: int) -> Optional[float]:
+    key = (doc.sha256, page_no)
+    hit = OCR_PROBE_CACHE.get(key)
+    if hit is None:
+        img = render_pdf_page(pdf_path, page_no, dpi=OCR_PROBE_DPI)
+        try:
+            hit = estimate_scan_font_pt(img, OCR_PROBE_DPI) or 0.0
+        finally:
+            img.close()
+        OCR_PROBE_CACHE.put(key, hit)
+    return hit or None
+
+
+def choose_ocr_dpi(doc: PdfDocument, page_no: int, options: OcrRenderOptions, pdf_path: Optional[str] = None) -> int:
+    # Pages without a text layer are sized from a cheap probe render when the PDF path is known.
+    if not options.adaptive_dpi:
+        return options.dpi
+    dpi = float(options.dpi)
+    font_pt = doc.page_font_size(page_no)
+    if not font_pt and pdf_path is not None:
+        font_pt = scan_font_size(doc, pdf_path, page_no)
+    if font_pt:
+        dpi = min(OCR_MAX_DPI, max(OCR_MIN_DPI, 72.0 * OCR_TARGET_GLYPH_PX / font_pt))
+    w_pt, h_pt = doc.page_size(page_no)
+    area_in = max(w_pt * h_pt / (72.0 * 72.0), 1e-6)
+    return int(min(dpi, math.sqrt(OCR_MAX_PIXELS / area_in)))
+
+
+def otsu_threshold(gray: Image.Image) -> int:
+    hist = np.asarray(gray.histogram()[:256], dtype=np.float64)
+    total = hist.sum()
+    if total == 0:
+        return 128
+    levels = np.arange(256)
+    w0 = np.cumsum(hist)
+    m0 = np.cumsum(hist * levels)
+    w1 = total - w0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        between = (m0[-1] * w0 / total - m0) ** 2 / (w0 * w1)
+    return int(np.nanargmax(between)) if np.isfinite(between).any() else 128
+
+
+def preprocess_for_ocr(img: Image.Image, options: OcrRenderOptions) -> Image.Image:
+    out = img.convert("L") if (options.grayscale or options.binarize) else img
+    if options.crop_margins:
+        gray = out if out.mode == "L" else out.convert("L")
+        box = gray.point(lambda v: 255 if v < 245 else 0).getbbox()
+        if box:
+            pad = 12
+            box = (max(0, box[0] - pad), max(0, box[1] - pad), min(out.width, box[2] + pad), min(out.height, box[3] + pad))
+            out = out.crop(box)
+    if options.binarize:
+        cut = otsu_threshold(out)
+        out = out.point(lambda v: 255 if v > cut else 0).convert("1")
+    return out
+
+
+def encode_image_compact(img: Image.Image) -> Tuple[str, bytes]:
+    # Smallest of lossless PNG and JPEG (bilevel images stay PNG: JPEG smears their edges).
+    png = io.BytesIO()
+    img.save(png, format="PNG", optimize=True)
+    best = ("image/png", png.getvalue())
+    if img.mode != "1":
+        jpg = io.BytesIO()
+        img.convert("L" if img.mode == "L" else "RGB").save(jpg, format="JPEG", quality=80, optimize=True)
+        if jpg.tell() < len(best[1]):
+            best = ("image/jpeg", jpg.getvalue())
+    return best
+
+
+def ocr_cache_key(pdf_sha256: str, page_no: int, engine: str, render: str, lang: str) -> str:
+    return json.dumps([pdf_sha256, page_no, engine, render, lang])
+
+
+def plan_ocr_batches(
+    doc: PdfDocument, page_numbers: List[int], render: OcrRenderOptions, batch_size: int, max_megapixels: float, pdf_path: Optional[str] = None
+) -> List[List[int]]:
+    # Consecutive pages are packed until either the page count or the estimated pixel budget is hit.
+    batches: List[List[int]] = []
+    current: List[int] = []
+    current_px = 0.0
+    for page_no in page_numbers:
+        w_pt, h_pt = doc.page_size(page_no)
+        px = w_pt * h_pt * (choose_ocr_dpi(doc, page_no, render, pdf_path) / 72.0) ** 2 / 1e6
+        if current and (len(current) >= batch_size or current_px + px > max_megapixels):
+            batches.append(current)
+            current, current_px = [], 0.0
+        current.append(page_no)
+        current_px += px
+    if current:
+        batches.append(current)
+    return batches
+
+
+def recognize_pdf_pages(
+    doc: PdfDocument,
+    page_numbers: List[int],
+    ocr_image: Callable[[Image.Image], str],
+    engine: str,
+    render: OcrRenderOptions = OcrRenderOptions(),
+    lang: str = TESSERACT_LANG,
+    workers: int = LOCAL_OCR_WORKERS,
+    limiter: Optional[RateLimiter] = None,
+    cache: Optional[DiskCache] = None,
+    progress: Optional[Callable[[int, int], None]] = None,
+    stats: Optional[Dict[str, Any]] = None,
+    ocr_batch: Optional[Callable[[List[Image.Image]], str]] = None,
+    batch_size: int = 1,
+    batch_max_megapixels: float = VISION_BATCH_MAX_MEGAPIXELS,
+    force_refresh: bool = False,
+) -> Dict[int, str]:
+    # With force_refresh every page is recognized again and its cache entry overwritten.
+    keys = {p: ocr_cache_key(doc.sha256, p, engine, render.tag(), lang) for p in set(page_numbers)}
+    texts: Dict[int, str] = {}
+    if cache is not None and not force_refresh:
+        for p, k in keys.items():
+            hit = cache.get(k)
+            if hit is not None:
+                texts[p] = hit
+    todo = sorted(set(page_numbers) - set(texts))
+    fallbacks: List[int] = []
+
+    if todo:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = doc.path
+            if path is None:
+                path = os.path.join(tmp, "ocr.pdf")
+                with open(path, "wb") as f:
+                    f.write(doc.read_bytes())
+            if ocr_batch is not None and batch_size > 1:
+                batches = plan_ocr_batches(doc, todo, render, batch_size, batch_max_megapixels, path)
+            else:
+                batches = [[p] for p in todo]
+
+            measured: List[Tuple[int, int, int, float]] = []
+
+            def ocr_pages(batch: List[int]) -> Optional[List[str]]:
+                # None means a multi-page reply could not be split; those pages are retried one by one.
+                started = time.perf_counter()
+                images, sizes = [], []
+                try:
+                    for page_no in batch:
+                        dpi = choose_ocr_dpi(doc, page_no, render, path)
+                        img = render_pdf_page(path, page_no, dpi=dpi)
+                        try:
+                            prepared = preprocess_for_ocr(img, render)
+                        except Exception:
+                            img.close()
+                            raise
+                        if prepared is not img:
+                            img.close()
+                        images.append(prepared)
+                        w_pt, h_pt = doc.page_size(page_no)
+                        sizes.append((dpi, prepared.width * prepared.height, int(w_pt * h_pt * (OCR_DPI / 72.0) ** 2)))
+
+                    if len(images) > 1:
+                        raw = ocr_batch(images)
+                        # A cut-off batch is missing its last pages; redo it page by page.
+                        parts = None if isinstance(raw, PartialText) else split_batch_output(raw, len(images))
+                    else:
+                        parts = [ocr_image(images[0])]
+                finally:
+                    for img in images:
+                        img.close()
+                if parts is None:
+                    return None
+
+                elapsed = (time.perf_counter() - started) / len(batch)
+                measured.extend((dpi, px, default_px, elapsed) for dpi, px, default_px in sizes)
+                if cache is not None:
+                    # Empty or cut-off pages are returned for this run but recognized again next time.
+                    for page_no, text in zip(batch, parts):
+                        if text.strip() and not isinstance(text, PartialText):
+                            cache.put(keys[page_no], text)
+                return parts
+
+            retry: List[List[int]] = []
+            for batch, parts in zip(batches, run_concurrently(batches, ocr_pages, max_in_flight=workers, limiter=limiter, progress=progress)):
+                if parts is None:
+                    fallbacks.append(len(batch))
+                    retry.extend([p] for p in batch)
+                else:
+                    texts.update(zip(batch, parts))
+            # Single-page fallbacks are tasks of their own, so each one is rate-limited and retried alone.
+            for batch, parts in zip(retry, run_concurrently(retry, ocr_pages, max_in_flight=workers, limiter=limiter, progress=progress)):
+                texts.update(zip(batch, parts))
+
+    if stats is not None:
+        stats.update({"engine": engine, "pages": len(keys), "native": 0, "cached": len(keys) - len(todo), "recognized": len(todo)})
+        if todo:
+            stats["render"] = {
+                "dpi": sorted({m[0] for m in measured}),
+                "megapixels": round(sum(m[1] for m in measured) / 1e6, 1),
+                "megapixels_at_default_dpi": round(sum(m[2] for m in measured) / 1e6, 1),
+                "seconds_per_page": round(sum(m[3] for m in measured) / len(measured), 2),
+                "requests": len(batches) + sum(fallbacks),
+                "batch_fallbacks": len(fallbacks),
+            }
+    return texts
+
+
+def ocr_pdf_pages(doc: PdfDocument, page_numbers: List[int], ocr_image: Callable[[Image.Image], str], engine: str, **kwargs) -> str:
+    # page_numbers are 1-based pages of doc; output sections are numbered in selection order.
+    texts = recognize_pdf_pages(doc, page_numbers, ocr_image, engine, **kwargs)
+    return join_ocr_pages([texts[p] for p in page_numbers])
+
+
+# Hybrid mode: born-digital pages keep their text layer, only scanned or garbled pages are OCR'd.
+HYBRID_MIN_CHARS = 80
+HYBRID_MIN_ALNUM_RATIO = 0.5
+
+
+def page_needs_ocr(text: str) -> bool:
+    dense = "".join((text or "").split())
+    if len(dense) < HYBRID_MIN_CHARS or "(cid:" in dense:
+        return True
+    alnum = sum(ch.isalnum() for ch in dense)
+    return alnum / len(dense) < HYBRID_MIN_ALNUM_RATIO or dense.count("\ufffd") * 20 > len(dense)
+
+
+def hybrid_ocr_pages(
+    doc: PdfDocument,
+    page_numbers: List[int],
+    ocr_image: Callable[[Image.Image], str],
+    engine: str,
+    stats: Optional[Dict[str, Any]] = None,
+    **kwargs,
+) -> str:
+    native = dict(doc.iter_page_texts(list(dict.fromkeys(page_numbers))))
+    needs_ocr = [p for p in dict.fromkeys(page_numbers) if page_needs_ocr(native[p])]
+    texts = {p: txt.strip() for p, txt in native.items()}
+    if needs_ocr:
+        texts.update(recognize_pdf_pages(doc, needs_ocr, ocr_image, engine, stats=stats, **kwargs))
+    elif stats is not None:
+        stats.update({"engine": engine, "cached": 0, "recognized": 0})
+    if stats is not None:
+        stats["native"] = len(native) - len(needs_ocr)
+        stats["pages"] = len(native)
+    return join_ocr_pages([texts[p] for p in page_numbers])
+
+
+# -----------------------------
+# Paged PDF preview
+# -----------------------------
+# Only the page on screen is rendered (plus its neighbours in the background), so preview cost
+# follows what is viewed rather than document size.
+PREVIEW_DPI = 96
+PREVIEW_PREFETCH = 1
+PREVIEW_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+
+@st.cache_resource(show_spinner=False)
+def preview_cache() -> BoundedLRUCache:
+    return BoundedLRUCache(PREVIEW_CACHE_MAX_BYTES, sizeof=len)
+
+
+@st.cache_resource(show_spinner=False)
+def preview_prefetcher() -> Tuple[ThreadPoolExecutor, set, threading.Lock]:
+    return ThreadPoolExecutor(max_workers=2), set(), threading.Lock()
+
+
+def render_preview_page(doc: PdfDocument, page_no: int, dpi: int = PREVIEW_DPI) -> bytes:
+    cache = preview_cache()
+    key = (doc.sha256, page_no, dpi)
+    hit = cache.get(key)
+    if hit is not None:
+        return hit
+    if doc.path is not None:
+        img = render_pdf_page(doc.path, page_no, dpi=dpi)
+    else:
+        img = convert_from_bytes(doc.read_bytes(), dpi=dpi, first_page=page_no, last_page=page_no)[0]
+    try:
+        buf = io.BytesIO()
+        img.convert("RGB").save(buf, format="JPEG", quality=85, optimize=True)
+    finally:
+        img.close()
+    data = buf.getvalue()
+    cache.put(key, data)
+    return data
+
+
+def trimmed_pdf_bytes(doc: PdfDocument, page_numbers: List[int]) -> bytes:
+    # Built once per page selection and shared with the page renders in the preview cache.
+    cache = preview_cache()
+    key = (doc.sha256, tuple(page_numbers))
+    hit = cache.get(key)
+    if hit is None:
+        hit = doc.write_pages(page_numbers)
+        cache.put(key, hit)
+    return hit
+
+
+def prefetch_preview_pages(doc: PdfDocument, page_numbers: List[int], dpi: int = PREVIEW_DPI) -> None:
+    pool, pending, lock = preview_prefetcher()
+    for page_no in page_numbers:
+        key = (doc.sha256, page_no, dpi)
+        with lock:
+            if key in pending or preview_cache().get(key) is not None:
+                continue
+            pending.add(key)
+
+        def job(page_no: int = page_no, key: Tuple = key) -> None:
+            try:
+                render_preview_page(doc, page_no, dpi=dpi)
+            except Exception:
+                pass
+            finally:
+                with lock:
+                    pending.discard(key)
+
+        pool.submit(job)
+
+
 # -----------------------------
 # Dataset Studio: parsing + standardization
 # -----------------------------
@@ -1882,7 +3900,7 @@ MAGICS = [
 ]
 
 
-def magic_run(magic_name: str, provider: str, model: str, api_key: str, raw_note: str, lang: str, max_tokens: int = 6000) -> str:
+def magic_run(magic_name: str, provider: str, model: str, api_key: str, raw_note: str, lang: str, max_tokens: int = 6000, **llm_kwargs) -> str:
     if lang == "zh-TW":
         system = "你是資深法規與技術編輯助理。請回傳乾淨、結構化的 Markdown。內容需保守、不可捏造，缺資料請用 Gap 標示。"
     else:
@@ -1890,34 +3908,31 @@ def magic_run(magic_name: str, provider: str, model: str, api_key: str, raw_note
 
     if magic_name == "Organize Note (Markdown)":
         user = f"請把以下筆記整理成結構化 Markdown（含標題、重點、待辦、風險/缺口、關鍵詞）：\n\n{raw_note}" if lang == "zh-TW" else f"Organize the following note into structured Markdown with headings, bullets, action items, gaps, and keywords:\n\n{raw_note}"
-        return call_llm_text(provider, model, api_key, system, user, max_tokens=max_tokens, temperature=0.2)
+        return call_llm_text(provider, model, api_key, system, user, max_tokens=max_tokens, temperature=0.2, **llm_kwargs)
 
     if magic_name == "Executive Summary":
         user = f"請產出一段高密度的主管摘要（Markdown，3~7 點重點）：\n\n{raw_note}" if lang == "zh-TW" else f"Create an executive summary (Markdown) with 3-7 key points:\n\n{raw_note}"
-        return call_llm_text(provider, model, api_key, system, user, max_tokens=max_tokens, temperature=0.2)
+        return call_llm_text(provider, model, api_key, system, user, max_tokens=max_tokens, temperature=0.2, **llm_kwargs)
 
     if magic_name == "Action Items + Owners":
         user = f"請從筆記抽取可執行待辦事項，輸出 Markdown 表格：Action、Owner(建議)、Due date(建議)、Rationale。\n\n{raw_note}" if lang == "zh-TW" else f"Extract action items. Output a Markdown table: Action, Owner (suggested), Due date (suggested), Rationale.\n\n{raw_note}"
-        return call_llm_text(provider, model, api_key, system, user, max_tokens=max_tokens, temperature=0.2)
+        return call_llm_text(provider, model, api_key, system, user, max_tokens=max_tokens, temperature=0.2, **llm_kwargs)
 
     if magic_name == "Risk/Deficiency Finder":
         user = f"請找出法規風險/缺失點，並以 [High/Med/Low] 分級；每點需包含證據摘錄（引用原文）。\n\n{raw_note}" if lang == "zh-TW" else f"Identify regulatory risks/deficiencies with [High/Med/Low] severity and evidence quotes.\n\n{raw_note}"
-        return call_llm_text(provider, model, api_key, system, user, max_tokens=max_tokens, temperature=0.2)
+        return call_llm_text(provider, model, api_key, system, user, max_tokens=max_tokens, temperature=0.2, **llm_kwargs)
 
     if magic_name == "Compliance Checklist Generator":
         user = f"請依常見 510(k) 審查主題產出合規核對清單（Markdown checkbox），如：biocompatibility、sterility、labeling、cybersecurity、software V&V。\n\n{raw_note}" if lang == "zh-TW" else f"Generate a compliance checklist (Markdown checkboxes) for common 510(k) topics.\n\n{raw_note}"
-        return call_llm_text(provider, model, api_key, system, user, max_tokens=max_tokens, temperature=0.2)
+        return call_llm_text(provider, model, api_key, system, user, max_tokens=max_tokens, temperature=0.2, **llm_kwargs)
 
     raise ValueError("AI Keywords Highlighter handled in UI.")
 
 
 def apply_keyword_colors(html_or_text: str, keyword_color_pairs: List[Tuple[str, str]]) -> str:
-    out = coral_highlight(html_or_text)
-    for kw, color in keyword_color_pairs:
-        if not kw.strip():
-            continue
-        out = out.replace(kw, f'<span style="color:{color}; font-weight:900; text-shadow:0 0 18px rgba(255,255,255,0.08)">{kw}</span>')
-    return out
+    if not html_or_text:
+        return ""
+    return highlight_html(html_or_text, highlight_keyword_set(None), normalize_color_pairs(keyword_color_pairs))
 
 
 # -----------------------------
@@ -1933,9 +3948,16 @@ def ss_init():
 
     st.session_state.setdefault("api_keys", {})
     st.session_state.setdefault("global_query", "")
+    st.session_state.setdefault("llm_cache_enabled", False)
+    st.session_state.setdefault("llm_force_refresh", False)
 
-    st.session_state.setdefault("pdf_bytes", None)
-    st.session_state.setdefault("trimmed_pdf_bytes", None)
+    st.session_state.setdefault("session_id", uuid.uuid4().hex)
+    st.session_state.setdefault("pdf_blob", None)
+    st.session_state.setdefault("pdf_doc", None)
+    st.session_state.setdefault("pdf_upload_id", None)
+    st.session_state.setdefault("trim_pages", None)
+    st.session_state.setdefault("search_min_overlap", NGRAM_MIN_OVERLAP)
+    st.session_state.setdefault("ocr_stats", {})
 
     st.session_state.setdefault("raw_text", "")
     st.session_state.setdefault("ocr_text", "")
@@ -1954,6 +3976,7 @@ def ss_init():
     st.session_state.setdefault("df_adr", pd.DataFrame(DEFAULT_ADR))
     st.session_state.setdefault("df_gudid", pd.DataFrame(DEFAULT_GUDID))
     st.session_state.setdefault("df_recall", pd.DataFrame(DEFAULT_RECALL))
+    st.session_state.setdefault("ds_fingerprints", {n: DEFAULT_FINGERPRINT for n in ["510k", "adr", "gudid", "recall"]})
 
     st.session_state.setdefault("ds_input_text", "")
     st.session_state.setdefault("ds_std_report", "")
@@ -1967,6 +3990,16 @@ def ss_init():
 
 ss_init()
 
+# Keep this session's uploads alive; if they were swept while the tab sat idle, forget them.
+if st.session_state["pdf_blob"] is not None:
+    if os.path.exists(st.session_state["pdf_blob"].path):
+        session_blob_store().touch(st.session_state["session_id"])
+    else:
+        st.session_state["pdf_blob"] = None
+        st.session_state["pdf_doc"] = None
+        st.session_state["pdf_upload_id"] = None
+        st.session_state["trim_pages"] = None
+
 
 def load_text_file(path: str, default: str) -> str:
     try:
@@ -1990,15 +4023,34 @@ style = st.session_state["style"]
 st.markdown(inject_css(theme, style["accent"]), unsafe_allow_html=True)
 
 
-def build_engine_from_session() -> RegulatorySearchEngine:
+@st.cache_resource(show_spinner=False)
+def shared_default_engine() -> RegulatorySearchEngine:
     return RegulatorySearchEngine(
-        st.session_state["df_510k"],
-        st.session_state["df_adr"],
-        st.session_state["df_gudid"],
-        st.session_state["df_recall"],
+        pd.DataFrame(DEFAULT_510K),
+        pd.DataFrame(DEFAULT_ADR),
+        pd.DataFrame(DEFAULT_GUDID),
+        pd.DataFrame(DEFAULT_RECALL),
+        fingerprints={n: DEFAULT_FINGERPRINT for n in ["510k", "adr", "gudid", "recall"]},
     )
 
 
+def build_engine_from_session() -> RegulatorySearchEngine:
+    # Embedded datasets: one engine for every session in the process.
+    # User-loaded datasets: a per-session engine that reuses the shared indexes it did not replace.
+    fps = st.session_state["ds_fingerprints"]
+    if all(v == DEFAULT_FINGERPRINT for v in fps.values()):
+        st.session_state.pop("search_engine", None)
+        return shared_default_engine()
+    dfs = (st.session_state["df_510k"], st.session_state["df_adr"], st.session_state["df_gudid"], st.session_state["df_recall"])
+    engine = st.session_state.get("search_engine")
+    if engine is None:
+        engine = RegulatorySearchEngine(*dfs, fingerprints=fps, base=shared_default_engine())
+        st.session_state["search_engine"] = engine
+    else:
+        engine.sync(*dfs, fingerprints=fps)
+    return engine
+
+
 engine = build_engine_from_session()
 
 
@@ -2041,7 +4093,12 @@ with top:
             else f"<span class='chip'><span class='dot' style='background:var(--warn)'></span>{t(lang,'ocr')}: {t(lang,'empty')}</span>"
         )
 
-        st.markdown(f"<div class='wow-card'>{chips}{dataset_chip}{ocr_chip}</div>", unsafe_allow_html=True)
+        llm_cache_chip = ""
+        if st.session_state["llm_cache_enabled"] and llm_response_cache() is not None:
+            c = llm_response_cache()
+            llm_cache_chip = f"<span class='chip'><span class='dot' style='background:var(--ok)'></span>{t(lang,'llm_cache')}: {c.hits} {t(lang,'cache_hits')} / {c.misses} {t(lang,'cache_misses')}</span>"
+
+        st.markdown(f"<div class='wow-card'>{chips}{dataset_chip}{ocr_chip}{llm_cache_chip}</div>", unsafe_allow_html=True)
         mana = (len(st.session_state["agent_outputs"]) % 10) / 10.0
         st.progress(mana, text="Review Mana (agent runs)")
 
@@ -2084,6 +4141,13 @@ with st.sidebar:
             if v:
                 st.session_state["api_keys"][env_name] = v
 
+    st.divider()
+    st.markdown(f"<div class='wow-mini'><b>{t(lang,'llm_cache')}</b></div>", unsafe_allow_html=True)
+    st.checkbox(t(lang, "llm_cache_enable"), key="llm_cache_enabled")
+    st.checkbox(t(lang, "force_refresh"), key="llm_force_refresh", disabled=not st.session_state["llm_cache_enabled"])
+    if st.button(t(lang, "clear_llm_cache"), use_container_width=True, disabled=llm_response_cache() is None):
+        llm_response_cache().clear()
+
     st.divider()
 
     st.markdown(f"<div class='wow-card'><h4 style='margin:0'>{t(lang,'agents')}</h4></div>", unsafe_allow_html=True)
@@ -2123,7 +4187,7 @@ with qcol2:
     view_mode = st.selectbox(t(lang, "mode"), [t(lang, "command_center"), t(lang, "note_keeper")], index=0)
 
 query = st.session_state["global_query"].strip()
-d360 = engine.device_360_view(query) if query else None
+d360 = engine.device_360_view(query, st.session_state["search_min_overlap"]) if query else None
 
 st.markdown(f"<div class='wow-card'><h4 style='margin:0'>{t(lang,'dashboard')}</h4></div>", unsafe_allow_html=True)
 k1, k2, k3, k4 = st.columns(4)
@@ -2174,7 +4238,7 @@ if view_mode == t(lang, "note_keeper"):
                 if not api_key:
                     st.error(f"{env_name} missing.")
                 else:
-                    out = magic_run(magic, provider, model, api_key, st.session_state["note_raw"], lang=lang, max_tokens=int(max_tokens))
+                    out = magic_run(magic, provider, model, api_key, st.session_state["note_raw"], lang=lang, max_tokens=int(max_tokens), **llm_cache_kwargs())
                     st.session_state["note_md"] = out
                     st.session_state["note_render_html"] = coral_highlight(out)
         else:
@@ -2215,11 +4279,14 @@ else:
 
         with a1:
             pdf = st.file_uploader("Upload PDF", type=["pdf"], key="cc_pdf_upload")
-            if pdf:
-                st.session_state["pdf_bytes"] = pdf.read()
-                st.session_state["trimmed_pdf_bytes"] = None
-
-            if st.session_state["pdf_bytes"]:
+            if pdf and st.session_state["pdf_upload_id"] != pdf.file_id:
+                pdf.seek(0)
+                st.session_state["pdf_blob"] = session_blob_store().put(st.session_state["session_id"], "upload.pdf", pdf)
+                st.session_state["pdf_doc"] = PdfDocument(st.session_state["pdf_blob"])
+                st.session_state["pdf_upload_id"] = pdf.file_id
+                st.session_state["trim_pages"] = None
+
+            if st.session_state["pdf_doc"]:
                 st.markdown(f"<div class='wow-mini'><b>{t(lang,'trim_pages')}</b></div>", unsafe_allow_html=True)
                 ranges = st.text_input(t(lang, "page_ranges"), value="1-2", key="cc_ranges")
                 do_preview = st.checkbox(t(lang, "render_pdf"), value=True, key="cc_preview")
@@ -2229,52 +4296,153 @@ else:
                     if st.button(t(lang, "trim_extract"), use_container_width=True, key="cc_trim_extract"):
                         try:
                             pr = parse_page_ranges(ranges) or [(1, 1)]
-                            trimmed = trim_pdf_bytes(st.session_state["pdf_bytes"], pr)
-                            st.session_state["trimmed_pdf_bytes"] = trimmed
-                            st.session_state["raw_text"] = extract_text_pypdf2(trimmed)
+                            doc = st.session_state["pdf_doc"]
+                            st.session_state["trim_pages"] = expand_page_ranges(pr, doc.page_count)
+                            st.session_state["raw_text"] = doc.extract_text(st.session_state["trim_pages"])
                             st.session_state["ocr_text"] = st.session_state["raw_text"]
                         except Exception as e:
                             st.error(f"Trim/Extract failed: {e}")
 
                 with colB:
-                    trimmed = st.session_state["trimmed_pdf_bytes"] or st.session_state["pdf_bytes"]
+                    doc = st.session_state["pdf_doc"]
+                    view_pages = st.session_state["trim_pages"]
+                    trimmed = (lambda: trimmed_pdf_bytes(doc, view_pages)) if view_pages is not None else doc.read_bytes
                     st.download_button(t(lang, "download_trimmed"), data=trimmed, file_name="trimmed.pdf", use_container_width=True, key="cc_download_trimmed")
 
                 if do_preview:
-                    st.markdown(render_pdf_iframe(st.session_state["trimmed_pdf_bytes"] or st.session_state["pdf_bytes"]), unsafe_allow_html=True)
+                    doc = st.session_state["pdf_doc"]
+                    view_pages = st.session_state["trim_pages"]
+                    if view_pages is None:
+                        view_pages = list(range(1, doc.page_count + 1))
+                    preview_mode = st.radio(t(lang, "preview_mode"), [t(lang, "preview_paged"), t(lang, "preview_embedded")], horizontal=True, key="cc_preview_mode")
+                    if preview_mode == t(lang, "preview_paged"):
+                        pos = st.number_input(t(lang, "preview_page"), min_value=1, max_value=max(1, len(view_pages)), value=1, step=1, key="cc_preview_page")
+                        pos = min(int(pos), len(view_pages))
+                        if view_pages:
+                            page_no = view_pages[pos - 1]
+                            try:
+                                st.image(render_preview_page(doc, page_no), caption=f"{pos}/{len(view_pages)} · p.{page_no}", use_container_width=True)
+                            except Exception as e:
+                                st.warning(f"Preview failed: {e}")
+                            neighbours = view_pages[max(0, pos - 1 - PREVIEW_PREFETCH) : pos - 1] + view_pages[pos : pos + PREVIEW_PREFETCH]
+                            prefetch_preview_pages(doc, neighbours)
+                    else:
+                        preview = trimmed_pdf_bytes(doc, view_pages) if st.session_state["trim_pages"] is not None else doc.read_bytes()
+                        st.markdown(render_pdf_iframe(preview), unsafe_allow_html=True)
 
                 st.divider()
                 st.markdown(f"<div class='wow-mini'><b>{t(lang,'ocr_engine')}</b></div>", unsafe_allow_html=True)
-                ocr_engine = st.selectbox(t(lang, "ocr_engine"), [t(lang, "extract_text"), t(lang, "local_ocr"), t(lang, "vision_ocr")], index=0, key="cc_ocr_engine")
+                ocr_engine = st.selectbox(
+                    t(lang, "ocr_engine"),
+                    [t(lang, "extract_text"), t(lang, "hybrid_ocr"), t(lang, "local_ocr"), t(lang, "vision_ocr")],
+                    index=0,
+                    key="cc_ocr_engine",
+                )
                 ocr_ranges = st.text_input(t(lang, "ocr_pages"), value=ranges, key="cc_ocr_ranges")
+                ocr_backend = ocr_engine
+                if ocr_engine == t(lang, "hybrid_ocr"):
+                    ocr_backend = st.selectbox(t(lang, "hybrid_backend"), [t(lang, "local_ocr"), t(lang, "vision_ocr")], index=0, key="cc_hybrid_backend")
+                if ocr_backend == t(lang, "local_ocr"):
+                    ocr_workers = st.number_input(t(lang, "ocr_workers"), min_value=1, max_value=max(1, os.cpu_count() or 1), value=LOCAL_OCR_WORKERS, step=1, key="cc_ocr_workers")
+                if ocr_backend == t(lang, "vision_ocr"):
+                    vcol1, vcol2, vcol3, vcol4 = st.columns([1, 1, 1, 1])
+                    with vcol1:
+                        vprov = st.selectbox("Vision provider", ["openai", "gemini"], index=0, key="cc_vision_provider")
+                    with vcol2:
+                        vmodel = st.selectbox("Vision model", provider_model_map()[vprov], index=0, key="cc_vision_model")
+                    with vcol3:
+                        vinflight = st.number_input(t(lang, "max_in_flight"), min_value=1, max_value=16, value=VISION_MAX_IN_FLIGHT, step=1, key="cc_vision_in_flight")
+                    with vcol4:
+                        vbatch = st.number_input(t(lang, "pages_per_request"), min_value=1, max_value=VISION_BATCH_MAX_PAGES, value=VISION_BATCH_PAGES, step=1, key="cc_vision_batch")
+                if ocr_engine != t(lang, "extract_text"):
+                    rcol1, rcol2, rcol3, rcol4 = st.columns([1, 1, 1, 1])
+                    with rcol1:
+                        r_adaptive = st.checkbox(t(lang, "adaptive_dpi"), value=True, key="cc_ocr_adaptive_dpi")
+                    with rcol2:
+                        r_gray = st.checkbox(t(lang, "grayscale"), value=True, key="cc_ocr_grayscale")
+                    with rcol3:
+                        r_binarize = st.checkbox(t(lang, "binarize"), value=False, key="cc_ocr_binarize")
+                    with rcol4:
+                        r_crop = st.checkbox(t(lang, "crop_margins"), value=True, key="cc_ocr_crop")
+                    render_options = OcrRenderOptions(adaptive_dpi=r_adaptive, grayscale=r_gray, binarize=r_binarize, crop_margins=r_crop)
+
+                if ocr_engine != t(lang, "extract_text"):
+                    fcol1, fcol2 = st.columns([1, 1])
+                    with fcol1:
+                        ocr_force = st.checkbox(t(lang, "ocr_force_refresh"), value=False, key="cc_ocr_force")
+                    with fcol2:
+                        if st.button(t(lang, "clear_ocr_cache"), use_container_width=True, key="cc_ocr_clear", disabled=ocr_cache() is None):
+                            ocr_cache().clear()
 
                 if st.button(f"{t(lang,'ocr')} {t(lang,'run_agent')}", use_container_width=True, key="cc_run_ocr"):
                     try:
                         pr = parse_page_ranges(ocr_ranges) or [(1, 1)]
-                        pdf_bytes = st.session_state["trimmed_pdf_bytes"] or st.session_state["pdf_bytes"]
-                        trimmed_for_ocr = trim_pdf_bytes(pdf_bytes, pr)
+                        # OCR ranges refer to the trimmed document; map them back to pages of the
+                        # original upload so cached pages are reused across different trims.
+                        doc = st.session_state["pdf_doc"]
+                        source_pages = st.session_state["trim_pages"]
+                        if source_pages is None:
+                            source_pages = list(range(1, doc.page_count + 1))
+                        ocr_page_numbers = [source_pages[i - 1] for i in expand_page_ranges(pr, len(source_pages))]
 
                         if ocr_engine == t(lang, "extract_text"):
-                            st.session_state["ocr_text"] = extract_text_pypdf2(trimmed_for_ocr)
-                        elif ocr_engine == t(lang, "local_ocr"):
-                            images = convert_from_bytes(trimmed_for_ocr, dpi=220)
-                            pages = []
-                            for i, img in enumerate(images, start=1):
-                                pages.append(f"\n\n--- PAGE {i} ---\n{pytesseract.image_to_string(img)}")
-                            st.session_state["ocr_text"] = "\n".join(pages).strip()
+                            st.session_state["ocr_text"] = doc.extract_text(ocr_page_numbers)
                         else:
-                            vprov = st.selectbox("Vision provider", ["openai", "gemini"], index=0, key="cc_vision_provider")
-                            vmodel = st.selectbox("Vision model", provider_model_map()[vprov], index=0, key="cc_vision_model")
-                            env_name = {"openai": "OPENAI_API_KEY", "gemini": "GEMINI_API_KEY"}[vprov]
-                            api_key = env_or_session(env_name)
-                            if not api_key:
-                                st.error(f"{env_name} missing.")
+                            ocr_kwargs = None
+                            payload_sizes: List[int] = []
+                            if ocr_backend == t(lang, "local_ocr"):
+                                ocr_kwargs = {
+                                    "ocr_image": lambda img: pytesseract.image_to_string(img, lang=TESSERACT_LANG),
+                                    "engine": "tesseract",
+                                    "workers": int(ocr_workers),
+                                }
                             else:
-                                images = convert_from_bytes(trimmed_for_ocr, dpi=220)
-                                st.session_state["ocr_text"] = call_vision_ocr(vprov, vmodel, api_key, images, lang=lang, max_tokens=12000)
+                                env_name = {"openai": "OPENAI_API_KEY", "gemini": "GEMINI_API_KEY"}[vprov]
+                                api_key = env_or_session(env_name)
+                                if not api_key:
+                                    st.error(f"{env_name} missing.")
+                                else:
+                                    request = vision_ocr_request(vprov, vmodel, api_key, lang, max_tokens=12000, payload_sizes=payload_sizes)
+                                    ocr_kwargs = {
+                                        "ocr_image": lambda img: request([img]),
+                                        "ocr_batch": request,
+                                        "batch_size": int(vbatch),
+                                        "engine": f"vision:{vprov}:{vmodel}",
+                                        "lang": lang,
+                                        "workers": int(vinflight),
+                                        "limiter": provider_rate_limiter(vprov),
+                                    }
+
+                            if ocr_kwargs:
+                                run_ocr = hybrid_ocr_pages if ocr_engine == t(lang, "hybrid_ocr") else ocr_pdf_pages
+                                bar = st.progress(0.0, text=ocr_engine)
+                                st.session_state["ocr_stats"] = {}
+                                st.session_state["ocr_text"] = run_ocr(
+                                    doc,
+                                    ocr_page_numbers,
+                                    cache=ocr_cache(),
+                                    force_refresh=ocr_force,
+                                    progress=lambda done, total: bar.progress(done / total, text=f"{ocr_engine}: {done}/{total}"),
+                                    stats=st.session_state["ocr_stats"],
+                                    render=render_options,
+                                    **ocr_kwargs,
+                                )
+                                if payload_sizes and "render" in st.session_state["ocr_stats"]:
+                                    st.session_state["ocr_stats"]["render"]["payload_kb"] = round(sum(payload_sizes) / 1024, 1)
                     except Exception as e:
                         st.error(f"OCR failed: {e}")
 
+                ocr_stats = st.session_state["ocr_stats"]
+                if ocr_stats:
+                    st.caption(t(lang, "ocr_cache_stats").format(**ocr_stats))
+                    if "render" in ocr_stats:
+                        rs = ocr_stats["render"]
+                        line = t(lang, "ocr_render_stats").format(default_dpi=OCR_DPI, **{**rs, "dpi": "/".join(map(str, rs["dpi"]))})
+                        if "payload_kb" in rs:
+                            line += f" · {t(lang, 'ocr_payload')}: {rs['payload_kb']} KB"
+                            line += " · " + t(lang, "ocr_requests").format(**rs)
+                        st.caption(line)
+
         with a2:
             st.session_state["ocr_text"] = st.text_area("OCR Text", st.session_state["ocr_text"], height=520, key="cc_ocr_text")
             st.caption("Coral highlights render on the Intelligence side.")
@@ -2312,12 +4480,35 @@ else:
                     st.dataframe(pd.DataFrame(gu), use_container_width=True, height=220) if gu else st.write("—")
 
                 st.divider()
-                results = engine.search_all(query)
+                results = engine.search_all(query, st.session_state["search_min_overlap"])
+                stats = engine.search_stats(query, st.session_state["search_min_overlap"])
+                st.caption(
+                    " | ".join(
+                        f"{name}: {stats[name].get('candidates', 0)}/{stats[name].get('rows', 0)} candidates (pruned {stats[name].get('pruning_ratio', 0.0):.0%})"
+                        for name in ["510k", "recall", "adr", "gudid"]
+                        if name in stats
+                    )
+                )
+                st.slider(t(lang, "min_overlap"), min_value=0.0, max_value=1.0, step=0.05, key="search_min_overlap", help=t(lang, "min_overlap_help"))
                 for name in ["510k", "recall", "adr", "gudid"]:
                     st.markdown(f"<div class='wow-mini'><b>{name.upper()}</b> ({len(results[name])})</div>", unsafe_allow_html=True)
                     if results[name]:
                         st.dataframe(pd.DataFrame([r.record for r in results[name]]), use_container_width=True, height=220)
 
+                if detect_identifier(query) == "k_number":
+                    st.divider()
+                    st.markdown(f"<div class='wow-mini'><b>{t(lang,'lineage')}</b> — {query.upper()}</div>", unsafe_allow_html=True)
+                    depth = st.number_input(t(lang, "lineage_depth"), min_value=1, max_value=50, value=5, step=1, key="lineage_depth")
+                    lA, lB = st.columns(2)
+                    with lA:
+                        st.caption(t(lang, "ancestors"))
+                        anc = engine.predicate_lineage(query, direction="ancestors", max_depth=int(depth))
+                        st.dataframe(pd.DataFrame(anc), use_container_width=True, height=220) if anc else st.write("—")
+                    with lB:
+                        st.caption(t(lang, "descendants"))
+                        desc = engine.predicate_lineage(query, direction="descendants", max_depth=int(depth))
+                        st.dataframe(pd.DataFrame(desc), use_container_width=True, height=220) if desc else st.write("—")
+
         with b1:
             if not agents_cfg or not agents_cfg.agents:
                 st.warning("No agents loaded. Upload or edit agents.yaml in the sidebar.")
@@ -2349,6 +4540,21 @@ else:
                 else:
                     base_input = st.session_state["ocr_text"]
 
+                token_budget = st.number_input(t(lang, "token_budget"), min_value=2000, max_value=1_000_000, value=AGENT_INPUT_TOKEN_BUDGET, step=1000, key="agent_token_budget")
+                input_tokens = estimate_tokens(base_input)
+                if input_tokens > token_budget:
+                    st.caption(t(lang, "input_over_budget").format(tokens=input_tokens))
+                else:
+                    st.caption(t(lang, "input_tokens").format(tokens=input_tokens))
+                pc1, pc2 = st.columns(2)
+                with pc1:
+                    prefix_cache = st.checkbox(t(lang, "prefix_cache"), value=True, key="agent_prefix_cache")
+                with pc2:
+                    doc_in_prefix = st.checkbox(t(lang, "doc_in_prefix"), value=True, key="agent_doc_prefix", disabled=not prefix_cache)
+                skill = st.session_state["skill_md"].strip()
+                # With prefix caching SKILL.md travels separately so its tokens are identical across agents.
+                agent_prompts = lambda sp: (sp.strip(), skill or None) if prefix_cache else ((skill + "\n\n" + sp.strip()).strip(), None)
+
                 run_colA, run_colB = st.columns([1, 1])
                 with run_colA:
                     if st.button(t(lang, "execute_next"), use_container_width=True, key="agent_execute"):
@@ -2357,12 +4563,52 @@ else:
                         if not api_key:
                             st.error(f"{env_name} missing.")
                         else:
-                            full_system = (st.session_state["skill_md"].strip() + "\n\n" + system_prompt.strip()).strip()
-                            full_user = f"{user_prompt.strip()}\n\n---\nINPUT:\n{base_input}"
+                            full_system, cache_prefix = agent_prompts(system_prompt)
                             try:
-                                out = call_llm_text(provider, model, api_key, full_system, full_user, max_tokens=int(max_tokens), temperature=float(agent.temperature))
+                                live = st.empty()
+                                streamed: List[str] = []
+                                last_paint = [0.0]
+
+                                def paint(chunk: str) -> None:
+                                    streamed.append(chunk)
+                                    now = time.perf_counter()
+                                    if now - last_paint[0] >= AGENT_STREAM_REPAINT_SECONDS:
+                                        last_paint[0] = now
+                                        live.markdown("".join(streamed) + " ▌")
+
+                                run_stats: Dict[str, Any] = {}
+                                map_bar = st.empty()
+                                out = run_agent_call(
+                                    provider,
+                                    model,
+                                    api_key,
+                                    full_system,
+                                    user_prompt,
+                                    base_input,
+                                    max_tokens=int(max_tokens),
+                                    temperature=float(agent.temperature),
+                                    token_budget=int(token_budget),
+                                    lang=lang,
+                                    on_chunk=paint,
+                                    stats=run_stats,
+                                    progress=lambda done, total: map_bar.progress(done / total, text=f"{t(lang,'chunks')}: {done}/{total}"),
+                                    cache_prefix=cache_prefix,
+                                    cache_document=prefix_cache and doc_in_prefix,
+                                    **llm_cache_kwargs(),
+                                )
+                                map_bar.empty()
+                                live.empty()
                                 st.session_state["agent_outputs"].append(
-                                    {"agent_id": agent.id, "name": agent.name, "provider": provider, "model": model, "input": base_input, "output": out, "edited_output": out}
+                                    {
+                                        "agent_id": agent.id,
+                                        "name": agent.name,
+                                        "provider": provider,
+                                        "model": model,
+                                        "input": base_input,
+                                        "output": out,
+                                        "edited_output": out,
+                                        "stats": run_stats,
+                                    }
                                 )
                             except Exception as e:
                                 st.error(f"Agent run failed: {e}")
@@ -2372,11 +4618,96 @@ else:
                         if st.session_state["agent_outputs"]:
                             st.session_state["final_report"] += "\n\n" + st.session_state["agent_outputs"][-1]["edited_output"]
 
+                with st.expander(t(lang, "pipeline_mode")):
+                    agent_labels = {a.id: f"{a.name} ({a.id})" + (f" ← {', '.join(a.depends_on)}" if a.depends_on else "") for a in agents_cfg.agents}
+                    pipe_ids = st.multiselect(t(lang, "pipeline_agents"), list(agent_labels), format_func=agent_labels.get, key="pipeline_agents")
+                    rerun_parents = st.checkbox(t(lang, "pipeline_rerun_parents"), value=False, key="pipeline_rerun_parents")
+                    if st.button(t(lang, "run_pipeline"), use_container_width=True, key="pipeline_run", disabled=not pipe_ids):
+                        try:
+                            # Unselected parents that already ran feed their latest (possibly edited) output instead of re-running.
+                            latest = {} if rerun_parents else {run["agent_id"]: run for run in st.session_state["agent_outputs"]}
+                            by_id = {a.id: a for a in agents_cfg.agents}
+                            plan = plan_agent_pipeline(agents_cfg.agents, pipe_ids, reuse_ids=set(latest))
+                            planned_ids = {a.id for a in plan}
+                            reused = {
+                                aid: PipelineResult(agent=by_id[aid], input=run["input"], output=run["edited_output"], stats={"reused": True})
+                                for aid, run in latest.items()
+                                if aid in by_id and aid not in planned_ids
+                            }
+                            env_names = {"openai": "OPENAI_API_KEY", "gemini": "GEMINI_API_KEY", "anthropic": "ANTHROPIC_API_KEY", "xai": "XAI_API_KEY"}
+                            pipe_keys = {p: env_or_session(env_names[p]) for p in {a.provider for a in plan} if p in env_names}
+                            missing = sorted({env_names.get(a.provider, a.provider) for a in plan if not pipe_keys.get(a.provider)})
+                            if missing:
+                                st.error(f"{', '.join(missing)} missing.")
+                            else:
+                                # Session state is not reachable from worker threads; capture what the agents need here.
+                                cache_kwargs = llm_cache_kwargs()
+                                pipe_doc_prefix = prefix_cache and doc_in_prefix
+
+                                def run_pipeline_agent(a: AgentDef, agent_input: str, run_stats: Dict[str, Any]) -> str:
+                                    agent_system, cache_prefix = agent_prompts(a.system_prompt)
+                                    return run_agent_call(
+                                        a.provider,
+                                        a.model,
+                                        pipe_keys[a.provider],
+                                        agent_system,
+                                        a.user_prompt,
+                                        agent_input,
+                                        max_tokens=int(a.max_tokens),
+                                        temperature=float(a.temperature),
+                                        token_budget=int(token_budget),
+                                        lang=lang,
+                                        stats=run_stats,
+                                        cache_prefix=cache_prefix,
+                                        cache_document=pipe_doc_prefix,
+                                        **cache_kwargs,
+                                    )
+
+                                bar = st.progress(0.0, text=t(lang, "run_pipeline"))
+                                finished = []
+
+                                def on_agent_done(res: PipelineResult) -> None:
+                                    finished.append(res)
+                                    bar.progress(len(finished) / len(plan), text=f"{len(finished)}/{len(plan)} · {res.agent.name}")
+
+                                started = time.perf_counter()
+                                results = asyncio.run(run_agent_pipeline(plan, base_input, run_pipeline_agent, on_done=on_agent_done, reused=reused))
+                                for res in results:
+                                    if res.error:
+                                        st.warning(f"{res.agent.name}: {res.error}")
+                                        continue
+                                    st.session_state["agent_outputs"].append(
+                                        {
+                                            "agent_id": res.agent.id,
+                                            "name": res.agent.name,
+                                            "provider": res.agent.provider,
+                                            "model": res.agent.model,
+                                            "input": res.input,
+                                            "output": res.output,
+                                            "edited_output": res.output,
+                                            "stats": res.stats,
+                                        }
+                                    )
+                                st.caption(t(lang, "pipeline_done").format(n=sum(1 for r in results if not r.error), total=len(results), seconds=round(time.perf_counter() - started, 1)))
+                                used = sorted({d for a in plan for d in a.depends_on if d in reused})
+                                if used:
+                                    st.caption(t(lang, "pipeline_reused").format(agents=", ".join(by_id[d].name for d in used)))
+                        except ValueError as e:
+                            st.error(f"{t(lang,'pipeline_mode')}: {e}")
+
                 st.divider()
                 if st.session_state["agent_outputs"]:
                     for i, run in enumerate(reversed(st.session_state["agent_outputs"])):
                         idx = len(st.session_state["agent_outputs"]) - 1 - i
-                        st.markdown(f"<div class='wow-mini'><b>Run {idx+1}</b> — {run['name']} ({run['provider']} / {run['model']})</div>", unsafe_allow_html=True)
+                        timing = run.get("stats") or {}
+                        timing_txt = f" · TTFT {timing['ttft_s']}s / {timing['total_s']}s" if "ttft_s" in timing and "total_s" in timing else ""
+                        if "chunks" in timing:
+                            timing_txt += f" · {timing['chunks']} {t(lang,'chunks')} / {timing['llm_calls']} calls"
+                        if timing.get("input_tokens"):
+                            timing_txt += f" · {t(lang,'cached_tokens')} {timing.get('cached_tokens', 0)}/{timing['input_tokens']} tok"
+                        if timing.get("truncated"):
+                            timing_txt += " · ⚠️ " + t(lang, "truncated").format(reason=timing["truncated"])
+                        st.markdown(f"<div class='wow-mini'><b>Run {idx+1}</b> — {run['name']} ({run['provider']} / {run['model']}){timing_txt}</div>", unsafe_allow_html=True)
                         v1, v2 = st.tabs([f"Render #{idx+1}", f"{t(lang,'edit_output_for_next')} #{idx+1}"])
                         with v1:
                             html = coral_highlight(run["output"])
@@ -2430,6 +4761,7 @@ else:
                             st.session_state["df_gudid"] = df_std
                         else:
                             st.session_state["df_recall"] = df_std
+                        st.session_state["ds_fingerprints"][ds_type] = dataset_fingerprint(df_std)
 
                         st.session_state["ds_filtered_df"] = pd.DataFrame()
                         st.session_state["ds_summary_md"] = ""
@@ -2447,6 +4779,7 @@ else:
                     st.session_state["df_adr"] = pd.DataFrame(DEFAULT_ADR)
                     st.session_state["df_gudid"] = pd.DataFrame(DEFAULT_GUDID)
                     st.session_state["df_recall"] = pd.DataFrame(DEFAULT_RECALL)
+                    st.session_state["ds_fingerprints"] = {n: DEFAULT_FINGERPRINT for n in ["510k", "adr", "gudid", "recall"]}
                     st.session_state["ds_std_report"] = ""
                     st.session_state["ds_filtered_df"] = pd.DataFrame()
                     st.session_state["ds_summary_md"] = ""
@@ -2523,7 +4856,7 @@ else:
                     sys = "You are a regulatory data analyst. Output Markdown." if lang != "zh-TW" else "你是法規資料分析專家，請輸出 Markdown。"
                     user = st.session_state["ds_summary_prompt"].strip() + "\n\n---\n" + ctx
                     try:
-                        st.session_state["ds_summary_md"] = call_llm_text(sum_provider, sum_model, api_key, sys, user, max_tokens=int(sum_max_tokens), temperature=0.2)
+                        st.session_state["ds_summary_md"] = call_llm_text(sum_provider, sum_model, api_key, sys, user, max_tokens=int(sum_max_tokens), temperature=0.2, **llm_cache_kwargs())
                     except Exception as e:
                         st.error(f"Summary failed: {e}")
 
@@ -2593,7 +4926,7 @@ else:
                     sys = "You are a regulatory dataset analyst. Output Markdown." if lang != "zh-TW" else "你是法規資料集分析助理，請輸出 Markdown。"
                     user = st.session_state["ds_query_prompt"].strip() + "\n\n---\n" + ctx
                     try:
-                        st.session_state["ds_query_md"] = call_llm_text(q_provider, q_model, api_key, sys, user, max_tokens=int(q_max_tokens), temperature=0.2)
+                        st.session_state["ds_query_md"] = call_llm_text(q_provider, q_model, api_key, sys, user, max_tokens=int(q_max_tokens), temperature=0.2, **llm_cache_kwargs())
                     except Exception as e:
                         st.error(f"Query failed: {e}")
 